@@ -0,0 +1,232 @@
+"""Benchmarks for caiman discovery against a local fake ec2 endpoint.
+
+Each fleet size is served by a FakeEc2Server and discovered through the real
+boto code path. Latency percentiles, api calls per lookup, memory per
+discovered instance and multi-threaded throughput are reported::
+
+    python -m benchmarks.discovery
+    python -m benchmarks.discovery --sizes 10 1000 --save benchmarks/baseline.json
+    python -m benchmarks.discovery --compare benchmarks/baseline.json
+
+With --compare the exit status is 1 when any metric regressed by more than
+--tolerance against the saved baseline.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+import caiman
+from benchmarks.fake_ec2 import FakeEc2Server, make_fleet
+
+SIZES = (10, 100, 1000, 10000)
+ENVIRONMENT_VARIABLE = 'CAIMAN_BENCHMARK_ENVIRONMENT'
+ROLES = ['role{}'.format(number) for number in range(10)]
+
+#: metrics where a larger value is better, everything else should shrink
+HIGHER_IS_BETTER = ('lookups_per_second', )
+#: reported but too noisy to flag as regressions
+UNGATED = ('p99_ms', 'max_ms')
+
+
+def percentiles(samples):
+    """Return p50, p90, p99 and max of samples in seconds, as milliseconds"""
+    samples = sorted(samples)
+
+    def at(fraction):
+        index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+        return samples[index] * 1000
+
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': samples[-1] * 1000}
+
+
+def measure(server, func, repeat):
+    """Time repeat calls of func, counting the api calls they make"""
+    func()  # warm up connections and caches
+    server.reset_calls()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    result = percentiles(samples)
+    result['api_calls_per_lookup'] = server.calls / float(repeat)
+    return result
+
+
+def bytes_per_instance(discover):
+    """Memory retained by the instances discover() returns"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        instances = discover()
+        for instance in instances:
+            instance.address
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / float(max(len(instances), 1))
+
+
+def throughput(func, threads, duration):
+    """Lookups per second made by threads calling func for duration"""
+    counts = [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        while time.perf_counter() < deadline:
+            func()
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(index, ))
+               for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return {'lookups_per_second': sum(counts) / duration}
+
+
+def bench_fleet(size, threads=8, duration=1.0, latency=0.0, rate=None):
+    """Return dict of benchmark name to metrics for a fleet of size"""
+    os.environ[ENVIRONMENT_VARIABLE] = 'demo'
+    repeat = max(5, min(50, 20000 // size))
+    results = {}
+    with FakeEc2Server(make_fleet(size), latency=latency) as server:
+        with server.patch_caiman(rate):
+            tag = caiman.get_name('web', 'demo')
+            running_instances = caiman.RunningInstances(ENVIRONMENT_VARIABLE)
+            paged = caiman.RunningInstances(ENVIRONMENT_VARIABLE, page_size=50)
+            cached = caiman.RunningInstances(ENVIRONMENT_VARIABLE,
+                                             cache=caiman.DiscoveryCache())
+            records = caiman.RunningInstances(ENVIRONMENT_VARIABLE,
+                                              records=True)
+
+            results['get_running_instances'] = measure(
+                server, lambda: list(caiman.get_running_instances(tag)),
+                repeat)
+            results['get_instances'] = measure(
+                server, lambda: list(running_instances.get_instances('web')),
+                repeat)
+            results['get_instances_cached'] = measure(
+                server, lambda: list(cached.get_instances('web')), repeat)
+            results['first_address'] = measure(
+                server, lambda: running_instances.first_address('web'), repeat)
+            results['first_address_paged'] = measure(
+                server, lambda: paged.first_address('web'), repeat)
+            results['resolve_many'] = measure(
+                server, lambda: running_instances.resolve_many(ROLES), repeat)
+
+            boto_instances = list(caiman.get_running_instances(tag))
+
+            def addresses():
+                for instance in boto_instances:
+                    caiman.Ec2Instance(instance).address
+            results['ec2instance_address'] = measure(server, addresses,
+                                                     repeat)
+
+            results['memory'] = {
+                'ec2instance_bytes_per_instance': bytes_per_instance(
+                    lambda: list(running_instances.get_instances('web'))),
+                'record_bytes_per_instance': bytes_per_instance(
+                    lambda: list(records.get_instances('web'))),
+            }
+
+            results['threaded_first_address'] = throughput(
+                lambda: running_instances.first_address('role1'),
+                threads, duration)
+            results['threaded_first_address_cached'] = throughput(
+                lambda: cached.first_address('role1'), threads, duration)
+    return results
+
+
+def run(sizes, threads=8, duration=1.0, latency=0.0, rate=None):
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': latency,
+        'rate_limit': rate,
+        'sizes': dict((str(size), bench_fleet(size, threads, duration,
+                                              latency, rate))
+                      for size in sizes),
+    }
+
+
+def compare(baseline, current, tolerance):
+    """Return list of (size, benchmark, metric, old, new) regressions"""
+    regressions = []
+    for size, benchmarks in current['sizes'].items():
+        for name, metrics in benchmarks.items():
+            old_metrics = baseline['sizes'].get(size, {}).get(name, {})
+            for metric, new in metrics.items():
+                old = old_metrics.get(metric)
+                if old is None or metric in UNGATED:
+                    continue
+                if metric == 'api_calls_per_lookup':
+                    regressed = new > old
+                elif metric in HIGHER_IS_BETTER:
+                    regressed = new < old * (1 - tolerance)
+                else:
+                    regressed = new > old * (1 + tolerance)
+                if regressed:
+                    regressions.append((size, name, metric, old, new))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    for size, benchmarks in sorted(results['sizes'].items(),
+                                   key=lambda item: int(item[0])):
+        out.write('\n{} instances\n'.format(size))
+        for name, metrics in sorted(benchmarks.items()):
+            out.write('  {:<32}{}\n'.format(name, '  '.join(
+                '{}={:.2f}'.format(metric, value)
+                for metric, value in sorted(metrics.items()))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds each throughput benchmark runs for')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every fake ec2 response')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='ec2 requests allowed per second, unlimited '
+                             'by default')
+    parser.add_argument('--save', metavar='PATH',
+                        help='write results to PATH as a baseline')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare results with the baseline at PATH')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown before a metric '
+                             'counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.threads, args.duration, args.latency,
+                  args.rate_limit)
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), results,
+                                  args.tolerance)
+        for size, name, metric, old, new in regressions:
+            sys.stdout.write('REGRESSION {} instances {} {}: {:.2f} -> {:.2f}\n'
+                             .format(size, name, metric, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
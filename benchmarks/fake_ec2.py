@@ -0,0 +1,256 @@
+"""Local stand-in for the ec2 DescribeInstances API.
+
+Serves a synthetic fleet over http so that caiman and boto can be exercised
+end to end without touching aws::
+
+    >>> fleet = make_fleet(1000)
+    >>> with FakeEc2Server(fleet) as server:
+    ...     with server.patch_caiman():
+    ...         caiman.RunningInstances('SOMA_ENVIRONMENT').first_address('web')
+
+Only the parts of DescribeInstances that caiman uses are implemented:
+filters, MaxResults and NextToken.
+"""
+import contextlib
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+import caiman
+
+ZONES = ('a', 'b', 'c')
+INSTANCE_TYPES = ('m1.small', 'm1.large', 'c1.xlarge')
+
+
+class FakeInstance(object):
+
+    def __init__(self, number, tags, region='eu-west-1', vpc_id='vpc-00000001'):
+        self.id = 'i-{:08x}'.format(number)
+        self.reservation_id = 'r-{:08x}'.format(number)
+        self.tags = tags
+        self.state = 'running'
+        self.region = region
+        self.vpc_id = vpc_id
+        self.availability_zone = region + ZONES[number % len(ZONES)]
+        self.instance_type = INSTANCE_TYPES[number % len(INSTANCE_TYPES)]
+        self.subnet_id = 'subnet-{:08x}'.format(number % len(ZONES))
+        self.private_ip_address = '10.{}.{}.{}'.format(
+            number >> 16 & 255, number >> 8 & 255, number & 255)
+        self.ip_address = '54.{}.{}.{}'.format(
+            number >> 16 & 255, number >> 8 & 255, number & 255)
+
+    def filter_values(self, name):
+        """Values the instance has for an ec2 filter name"""
+        if name == 'tag-key':
+            return set(self.tags)
+        if name.startswith('tag:'):
+            key = name[len('tag:'):]
+            return set([self.tags[key]]) if key in self.tags else set()
+        return set([{
+            'instance-state-name': self.state,
+            'vpc-id': self.vpc_id,
+            'availability-zone': self.availability_zone,
+            'instance-type': self.instance_type,
+            'subnet-id': self.subnet_id,
+        }[name]])
+
+    def matches(self, filters):
+        return all(self.filter_values(name) & values
+                   for name, values in filters.items())
+
+    def to_xml(self):
+        tags = ''.join('<item><key>{}</key><value>{}</value></item>'
+                       .format(escape(key), escape(value))
+                       for key, value in sorted(self.tags.items()))
+        return (
+            '<item>'
+            '<reservationId>{reservation_id}</reservationId>'
+            '<ownerId>123456789012</ownerId>'
+            '<groupSet/>'
+            '<instancesSet><item>'
+            '<instanceId>{id}</instanceId>'
+            '<imageId>ami-12345678</imageId>'
+            '<instanceState><code>16</code><name>{state}</name></instanceState>'
+            '<privateDnsName>ip-{dashed}.{region}.compute.internal</privateDnsName>'
+            '<dnsName>ec2-{public_dashed}.{region}.compute.amazonaws.com</dnsName>'
+            '<instanceType>{instance_type}</instanceType>'
+            '<placement><availabilityZone>{availability_zone}</availabilityZone>'
+            '<tenancy>default</tenancy></placement>'
+            '<subnetId>{subnet_id}</subnetId>'
+            '<vpcId>{vpc_id}</vpcId>'
+            '<privateIpAddress>{private_ip_address}</privateIpAddress>'
+            '<ipAddress>{ip_address}</ipAddress>'
+            '<tagSet>{tag_set}</tagSet>'
+            '</item></instancesSet>'
+            '</item>'
+        ).format(tag_set=tags,
+                 dashed=self.private_ip_address.replace('.', '-'),
+                 public_dashed=self.ip_address.replace('.', '-'),
+                 **self.__dict__)
+
+
+def make_fleet(size, roles=20, environments=('demo', 'production'),
+               large_role='web', region='eu-west-1'):
+    """Return a list of size FakeInstances spread across many tags
+
+    Half of the fleet carries the soma-<environment>-<large_role> tag, the
+    rest is spread evenly over `roles` other roles, so both large and small
+    tags can be looked up.
+    """
+    fleet = []
+    for number in range(size):
+        environment = environments[(number // 2) % len(environments)]
+        if number % 2 == 0:
+            role = large_role
+        else:
+            role = 'role{}'.format((number // 4) % roles)
+        tags = {caiman.get_name(role, environment): '',
+                'Name': '{}-{}-{}'.format(environment, role, number)}
+        fleet.append(FakeInstance(number, tags, region))
+    return fleet
+
+
+def parse_filters(params):
+    filters = {}
+    for number in itertools.count(1):
+        name = params.get('Filter.{}.Name'.format(number))
+        if name is None:
+            return filters
+        values = set()
+        for value_number in itertools.count(1):
+            value = params.get('Filter.{}.Value.{}'.format(number,
+                                                          value_number))
+            if value is None:
+                break
+            values.add(value)
+        filters[name] = values
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        params = dict((key, values[0])
+                      for key, values in parse_qs(body).items())
+        status, response = self.server.ec2.handle(params)
+        response = response.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeEc2Server(object):
+    """Threaded http server answering DescribeInstances for a fleet
+
+    Every request is counted in `calls` so that the number of api calls per
+    lookup can be measured. `latency` seconds are added to each response to
+    imitate the round trip to aws.
+    """
+
+    def __init__(self, fleet, latency=0.0, port=0):
+        self.fleet = fleet
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.ec2 = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = 0
+
+    def handle(self, params):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if params.get('Action') != 'DescribeInstances':
+            return 400, self._error('InvalidAction', params.get('Action'))
+
+        filters = parse_filters(params)
+        matches = [instance for instance in self.fleet
+                   if instance.matches(filters)]
+        start = int(params.get('NextToken', 0))
+        next_token = ''
+        if 'MaxResults' in params:
+            end = start + int(params['MaxResults'])
+            if end < len(matches):
+                next_token = '<nextToken>{}</nextToken>'.format(end)
+            matches = matches[start:end]
+        return 200, (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<DescribeInstancesResponse '
+            'xmlns="http://ec2.amazonaws.com/doc/2013-02-01/">'
+            '<requestId>fake</requestId>'
+            '<reservationSet>{}</reservationSet>{}'
+            '</DescribeInstancesResponse>'
+        ).format(''.join(instance.to_xml() for instance in matches),
+                 next_token)
+
+    def _error(self, code, message):
+        return ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors>'
+                '<Error><Code>{}</Code><Message>{}</Message></Error>'
+                '</Errors><RequestID>fake</RequestID></Response>'
+                .format(escape(code), escape(str(message))))
+
+    def connect_to_region(self, region_name, **kw_params):
+        """Drop in replacement for caiman.connect_to_region"""
+        from boto.ec2.connection import EC2Connection
+        from boto.regioninfo import RegionInfo
+
+        region = RegionInfo(name=region_name, endpoint='127.0.0.1')
+        return EC2Connection(aws_access_key_id='fake',
+                             aws_secret_access_key='fake',
+                             region=region, port=self.port, is_secure=False)
+
+    @contextlib.contextmanager
+    def patch_caiman(self, rate=None):
+        """Point caiman's discovery at this server
+
+        Requests are limited to rate per second, unlimited by default.
+        """
+        original = caiman.connect_to_region, caiman.rate_limiter
+        caiman.connect_to_region = self.connect_to_region
+        caiman.rate_limiter = caiman.TokenBucket(rate)
+        caiman.connection_pool.clear()
+        try:
+            yield self
+        finally:
+            caiman.connect_to_region, caiman.rate_limiter = original
+            caiman.connection_pool.clear()
@@ -1,11 +1,34 @@
 import os
+import copy
+import json
+import mmap
+import time
+import random
+import socket
 import logging
 import warnings
+import threading
 import functools
+import itertools
 import contextlib
-from boto.ec2 import connect_to_region
+import collections
 
 
+try:
+    import queue
+except ImportError:  # NOQA
+    import Queue as queue
+
+try:
+    import contextvars
+except ImportError:  # NOQA
+    contextvars = None
+
+try:
+    import fcntl
+except ImportError:  # NOQA
+    fcntl = None
+
 try:
     from logging import NullHandler
 except ImportError:  # NOQA
@@ -14,35 +37,1563 @@ except ImportError:  # NOQA
         def emit(self, record):
             pass
 
-# hardcoding to eu-west until we need more regions
+
+# region used unless RunningInstances is given a list of regions
 REGION = 'eu-west-1'
 
 logger = logging.getLogger(__name__)
 
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class Instrumentation(object):
+    """Receives measurements taken during discovery.
+
+    This implementation discards them; subclass it to forward them to a
+    metrics system and install it with set_instrumentation. Names reported
+    are:
+
+        * ``ec2.requests`` and ``ec2.errors``: counts of DescribeInstances
+          requests and of those that failed, by region
+        * ``ec2.request_seconds``: latency of DescribeInstances, by region
+        * ``ec2.throttled``: throttled DescribeInstances requests that were
+          retried, by region
+        * ``ec2.coalesced``: lookups that shared an identical request
+          already in flight rather than making their own
+        * ``discovery.instances``: instances returned per lookup, by tag
+        * ``discovery.wrap_seconds``: time spent wrapping each instance
+        * ``discovery.address_seconds``: time spent resolving each address
+        * ``cache.hits``, ``cache.stale_hits`` and ``cache.misses``: outcome
+          of DiscoveryCache lookups
+        * ``logging.dropped``: log records a full BufferedHandler discarded
+        * ``inventory.instances``: running instances found by an
+          InventoryIndex scan
+        * ``circuit.opened`` and ``circuit.rejected``: times a CircuitBreaker
+          opened, and calls it turned away while open
+        * ``discovery.stale``: lookups answered with last known good
+          instances because ec2 failed
+    """
+
+    def increment(self, name, value=1, **tags):
+        """Add value to the counter name"""
+
+    def observe(self, name, value, **tags):
+        """Record value, e.g. a duration in seconds, for the histogram name"""
+
+    @contextlib.contextmanager
+    def timer(self, name, **tags):
+        """Context manager observing how many seconds its block takes"""
+        start = _timer()
+        try:
+            yield
+        finally:
+            self.observe(name, _timer() - start, **tags)
+
+
+class Histogram(object):
+    """Count, sum, extremes and cumulative bucket counts of observations"""
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.bucket_counts = [0] * len(self.buckets)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                'max': self.max, 'buckets': buckets}
+
+
+class Metrics(Instrumentation):
+    """In-process counters and histograms of discovery measurements"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int)
+            self.histograms = collections.defaultdict(Histogram)
+
+    @staticmethod
+    def _key(name, tags):
+        if not tags:
+            return name
+        return '{}{{{}}}'.format(name, ','.join(
+            '{}={}'.format(key, value) for key, value in sorted(tags.items())))
+
+    def increment(self, name, value=1, **tags):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **tags):
+        key = self._key(name, tags)
+        with self._lock:
+            self.histograms[key].observe(value)
+
+    def snapshot(self):
+        """Return a json serialisable copy of every counter and histogram
+
+        Keys are metric names followed by their tags, e.g.
+        ``ec2.requests{region=eu-west-1}``.
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': dict((key, histogram.snapshot())
+                                   for key, histogram
+                                   in self.histograms.items()),
+            }
+
+
+#: receives every measurement taken by caiman, see set_instrumentation
+instrumentation = Instrumentation()
+
+
+def set_instrumentation(new_instrumentation):
+    """Send discovery measurements to new_instrumentation
+
+    :param Instrumentation new_instrumentation: e.g. a Metrics instance
+    :returns: the Instrumentation previously in use
+    """
+    global instrumentation
+    previous, instrumentation = instrumentation, new_instrumentation
+    return previous
+
+
+@contextlib.contextmanager
+def _ec2_request(region):
+    start = _timer()
+    try:
+        yield
+    except Exception:
+        instrumentation.increment('ec2.errors', region=region)
+        raise
+    finally:
+        instrumentation.increment('ec2.requests', region=region)
+        instrumentation.observe('ec2.request_seconds', _timer() - start,
+                                region=region)
+
+
+def connect_to_region(region_name, **kw_params):
+    """Return a boto ec2 connection to region_name
+
+    boto is imported on first use rather than with caiman, as plenty of
+    processes import caiman only for its logging configuration.
+    """
+    from boto.ec2 import connect_to_region as boto_connect_to_region
+    return boto_connect_to_region(region_name, **kw_params)
+
 
 def get_name(role, environment):
     return u'soma-{}-{}'.format(environment, role)
 
 
-def get_running_instances(name, vpc_id=None):
-    filters = {'tag-key': name,
+def parse_name(name):
+    """Return (role, environment) of a tag made by get_name, or None"""
+    prefix, _, rest = name.partition('-')
+    if prefix != 'soma' or '-' not in rest:
+        return None
+    environment, role = rest.split('-', 1)
+    return role, environment
+
+
+#: ec2 instance metadata service, see local_zone
+METADATA_URL = 'http://169.254.169.254/latest/'
+
+#: zone read from instance metadata, once it has been read
+_local_zone = []
+#: _timer() before which a failed metadata read is not retried
+_local_zone_retry = [0]
+
+
+def _read_metadata(path, timeout):
+    """Return the instance metadata at path, or None away from ec2"""
+    try:
+        from urllib.request import Request, urlopen
+        from urllib.error import HTTPError
+    except ImportError:  # NOQA
+        from urllib2 import Request, urlopen, HTTPError
+
+    headers = {}
+    token = Request(METADATA_URL + 'api/token',
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+    token.get_method = lambda: 'PUT'
+    try:
+        response = urlopen(token, timeout=timeout)
+        headers['X-aws-ec2-metadata-token'] = response.read().decode('utf-8')
+    except HTTPError:
+        pass  # metadata service that predates tokens
+    except Exception as error:
+        logger.debug('No instance metadata: %s', error)
+        return None
+    try:
+        response = urlopen(Request(METADATA_URL + path, headers=headers),
+                           timeout=timeout)
+        return response.read().decode('utf-8').strip() or None
+    except Exception as error:
+        logger.debug('Could not read instance metadata %s: %s', path, error)
+        return None
+
+
+def local_zone(timeout=0.5, retry_interval=60):
+    """Return the availability zone this process runs in, or None
+
+    The zone is read from ec2 instance metadata once per process; a failed
+    read is tried again after retry_interval seconds.
+    $CAIMAN_AVAILABILITY_ZONE overrides it, e.g. away from ec2.
+
+    :param number timeout: seconds to wait for the metadata service
+    :param number retry_interval: seconds before retrying a failed read
+    """
+    zone = os.environ.get('CAIMAN_AVAILABILITY_ZONE')
+    if zone:
+        return zone
+    if _local_zone:
+        return _local_zone[0]
+    if _timer() < _local_zone_retry[0]:
+        return None
+    zone = _read_metadata('meta-data/placement/availability-zone', timeout)
+    if zone is None:
+        _local_zone_retry[0] = _timer() + retry_interval
+        logger.warning('Could not read the availability zone from instance '
+                       'metadata, zone affinity is off for the next %s '
+                       'seconds', retry_interval)
+        return None
+    _local_zone.append(zone)
+    return zone
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of ec2 connections keyed by region.
+
+    Connections are checked out for the duration of a request and returned
+    afterwards, so their keep-alive http connections and credentials are
+    reused across calls and threads. At most ``maxsize`` idle connections are
+    kept per region. The pool empties itself in a forked child process rather
+    than sharing sockets with its parent.
+    """
+
+    def __init__(self, maxsize=4):
+        """
+
+        :param int maxsize: number of idle connections kept per region
+        """
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = collections.defaultdict(list)
+
+    def __len__(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+    @contextlib.contextmanager
+    def connection(self, region=REGION):
+        """Context manager providing a connection to region
+
+        Connections that raise are discarded instead of being returned to the
+        pool.
+
+        :param string region: name of the ec2 region
+        """
+        connection = self._acquire(region)
+        yield connection
+        self._release(region, connection)
+
+    def _acquire(self, region):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle[region]
+            if idle:
+                return idle.pop()
+        return connect_to_region(region)
+
+    def _release(self, region, connection):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            idle = self._idle[region]
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+
+    def resize(self, maxsize):
+        """Change the number of idle connections kept per region"""
+        with self._lock:
+            self.maxsize = maxsize
+            for idle in self._idle.values():
+                del idle[maxsize:]
+
+    def clear(self):
+        """Drop all idle connections"""
+        with self._lock:
+            self._reset()
+
+
+#: connections shared by every discovery call in this process
+connection_pool = ConnectionPool()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket limiting the rate of ec2 requests.
+
+    Up to ``capacity`` requests can be made at once, after which they are
+    let through at ``rate`` per second. A rate of None means no limit.
+    """
+
+    def __init__(self, rate, capacity=None, clock=_timer, sleep=time.sleep):
+        """
+
+        :param number rate: requests allowed per second
+        :param number capacity: largest burst of requests allowed
+        """
+        self.rate = rate
+        # below one whole token no request could ever be let through
+        self.capacity = max(1, capacity or rate) if rate is not None else None
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be made"""
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class Backoff(object):
+    """Retry policy for throttled ec2 requests: jittered exponential backoff
+
+    Throttled requests are retried up to ``attempts`` times, sleeping a
+    random time up to ``base * 2 ** attempt`` seconds, capped at ``cap``.
+    """
+
+    #: ec2 error codes that mean the request was throttled
+    throttling_errors = ('RequestLimitExceeded', 'Throttling',
+                         'ThrottlingException')
+
+    def __init__(self, attempts=5, base=0.1, cap=5.0, rng=None):
+        if rng is None:
+            rng = random.Random()
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self._random = rng
+
+    def is_throttled(self, error):
+        return getattr(error, 'error_code', None) in self.throttling_errors
+
+    def delay(self, attempt):
+        """Seconds to sleep before retry number attempt (from 0)"""
+        return self._random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class SingleFlight(object):
+    """Lets concurrent identical calls share the result of a single call"""
+
+    class _Call(object):
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """Return func(), or the result of the call for key already running
+
+        :param key: hashable identifying the call
+        :param callable func: makes the call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            instrumentation.increment('ec2.coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling ec2 while a CircuitBreaker is open"""
+
+
+class CircuitBreaker(object):
+    """Stops calling ec2 for a while once it keeps failing or is slow.
+
+    The circuit opens after ``failure_threshold`` consecutive calls either
+    raise or take longer than ``latency_threshold`` seconds. While open,
+    calls fail straight away with CircuitOpenError. After ``reset_timeout``
+    seconds the circuit is half open and a single trial call is let
+    through: if it succeeds the circuit closes again, otherwise it reopens.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, latency_threshold=None,
+                 reset_timeout=30, clock=_timer):
+        """
+
+        :param int failure_threshold: consecutive failures opening the
+            circuit
+        :param number latency_threshold: seconds after which a call counts
+            as a failure even though it returned, None for no limit
+        :param number reset_timeout: seconds the circuit stays open before a
+            trial call is let through
+        :param callable clock: returns the current time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """One of CLOSED, OPEN or HALF_OPEN"""
+        with self._lock:
+            if (self._state == self.OPEN and
+                    self._clock() - self._opened >= self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Return whether a call may be made now
+
+        A True return while half open reserves the single trial call, whose
+        outcome must be reported with record_success or record_failure.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if (self._state == self.OPEN and
+                    self._clock() - self._opened >= self.reset_timeout):
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+        instrumentation.increment('circuit.rejected')
+        return False
+
+    def record_success(self, seconds=0):
+        """Report a call that returned after seconds"""
+        if (self.latency_threshold is not None and
+                seconds > self.latency_threshold):
+            self.record_failure()
+            return
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        """Report a call that raised or was too slow"""
+        with self._lock:
+            self._failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    instrumentation.increment('circuit.opened')
+                self._state = self.OPEN
+                self._opened = self._clock()
+                self._trial = False
+
+    def call(self, func):
+        """Return func(), or raise CircuitOpenError while the circuit is open
+        """
+        if not self.allow():
+            raise CircuitOpenError('ec2 calls are suspended after repeated '
+                                   'failures')
+        start = self._clock()
+        try:
+            result = func()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(self._clock() - start)
+        return result
+
+
+#: shared by every ec2 request made by this process
+rate_limiter = TokenBucket(rate=20, capacity=40)
+#: how throttled ec2 requests are retried
+backoff = Backoff()
+#: identical DescribeInstances requests in flight
+_describe_calls = SingleFlight()
+
+
+def _call_ec2(region, request):
+    """Return request(connection) for a pooled connection to region
+
+    Requests wait for the rate limiter and throttled requests are retried
+    according to backoff.
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        with connection_pool.connection(region) as connection:
+            try:
+                with _ec2_request(region):
+                    return request(connection)
+            except Exception as error:
+                if (not backoff.is_throttled(error) or
+                        attempt >= backoff.attempts):
+                    raise
+        instrumentation.increment('ec2.throttled', region=region)
+        time.sleep(backoff.delay(attempt))
+        attempt += 1
+
+
+def _freeze(filters):
+    return tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in filters.items()))
+
+
+class Filters(object):
+    """Conditions instances must meet, sent to ec2 as DescribeInstances
+    filters so that only matching instances are returned.
+
+    Each condition can be a single value or a list of allowed values::
+
+        >>> Filters(availability_zone='eu-west-1a',
+        ...         instance_type=['m1.large', 'c1.xlarge'],
+        ...         tags={'team': 'search'})
+    """
+
+    #: ec2 filter name of each condition
+    names = (('vpc_id', 'vpc-id'),
+             ('availability_zone', 'availability-zone'),
+             ('instance_type', 'instance-type'),
+             ('subnet_id', 'subnet-id'))
+
+    def __init__(self, vpc_id=None, availability_zone=None,
+                 instance_type=None, subnet_id=None, tags=None):
+        """
+
+        :param string vpc_id: only instances within this vpc
+        :param string availability_zone: only instances in this zone
+        :param string instance_type: only instances of this type
+        :param string subnet_id: only instances within this subnet
+        :param dict tags: only instances with these values of these tags
+        """
+        self.vpc_id = vpc_id
+        self.availability_zone = availability_zone
+        self.instance_type = instance_type
+        self.subnet_id = subnet_id
+        self.tags = dict(tags or {})
+
+    @classmethod
+    def from_ec2(cls, filters):
+        """Alternate constructor from a dict of ec2 filter name to value,
+        as returned by to_ec2"""
+        attributes = dict((name, attribute) for attribute, name in cls.names)
+        kwargs = {'tags': {}}
+        for name, value in filters.items():
+            if name.startswith('tag:'):
+                kwargs['tags'][name[len('tag:'):]] = value
+            elif name in attributes:
+                kwargs[attributes[name]] = value
+            else:
+                raise ValueError('Cannot filter by {!r}, expected one of {} '
+                                 'or tag:<key>'.format(
+                                     name, ', '.join(sorted(attributes))))
+        return cls(**kwargs)
+
+    @classmethod
+    def parse(cls, specs):
+        """Alternate constructor from ec2 filter specs such as
+        'availability-zone=eu-west-1a', 'tag:team=search' or
+        'instance-type=m1.large,c1.xlarge'
+        """
+        filters = {}
+        for spec in specs:
+            name, separator, value = spec.partition('=')
+            if not separator:
+                raise ValueError('Expected <filter>=<value>, got {!r}'
+                                 .format(spec))
+            values = value.split(',')
+            filters[name] = values if len(values) > 1 else value
+        return cls.from_ec2(filters)
+
+    def to_ec2(self):
+        """Return dict of ec2 filter name to value"""
+        filters = dict(('tag:{}'.format(key), value)
+                       for key, value in self.tags.items())
+        for attribute, name in self.names:
+            value = getattr(self, attribute)
+            if value:
+                filters[name] = value
+        return filters
+
+    def key(self):
+        """Hashable, json serialisable equivalent used in cache keys"""
+        return _freeze(self.to_ec2())
+
+    def matches(self, instance):
+        """Whether a boto ec2instance meets every condition"""
+        tags = getattr(instance, 'tags', None) or {}
+        values = dict(('tag:{}'.format(key), tags.get(key))
+                      for key in self.tags)
+        values.update({
+            'vpc-id': getattr(instance, 'vpc_id', None),
+            'availability-zone': getattr(instance, 'placement', None),
+            'instance-type': getattr(instance, 'instance_type', None),
+            'subnet-id': getattr(instance, 'subnet_id', None),
+        })
+        for name, allowed in self.to_ec2().items():
+            if not isinstance(allowed, (list, tuple)):
+                allowed = [allowed]
+            if values[name] not in allowed:
+                return False
+        return True
+
+    def __bool__(self):
+        return bool(self.to_ec2())
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'Filters({!r})'.format(self.to_ec2())
+
+
+def _running_filters(tag_key, vpc_id=None, filters=None):
+    running = {'tag-key': tag_key,
                'instance-state-name': 'running',
                'vpc-id': vpc_id}
-    if not filters['vpc-id']:
-        del filters['vpc-id']
-    connection = connect_to_region(REGION)
-    reservations = connection.get_all_instances(filters=filters)
+    if not running['vpc-id']:
+        del running['vpc-id']
+    if filters:
+        running.update(filters)
+    return running
+
+
+def _describe_instances(filters, region=REGION):
+    def request(connection):
+        return connection.get_all_instances(filters=filters)
+
+    reservations = _describe_calls.do(
+        (region, _freeze(filters)), lambda: _call_ec2(region, request))
     for reservation in reservations:
         for instance in reservation.instances:
             yield instance
 
 
+def _describe_instance_pages(filters, region=REGION, page_size=100):
+    """Yield instances page by page, only requesting a page once needed
+
+    boto's get_all_instances gathers every page before returning, so the
+    DescribeInstances request is made directly with MaxResults/NextToken.
+    """
+    from boto.ec2.instance import Reservation
+
+    def request(connection):
+        params = {'MaxResults': page_size}
+        if next_token:
+            params['NextToken'] = next_token
+        connection.build_filter_params(params, filters)
+        return connection.get_list('DescribeInstances', params,
+                                   [('item', Reservation)], verb='POST')
+
+    next_token = None
+    while True:
+        page = _call_ec2(region, request)
+        for reservation in page:
+            for instance in reservation.instances:
+                yield instance
+        next_token = page.next_token
+        if not next_token:
+            return
+
+
+def _map_regions(func, regions, max_workers=None):
+    """Yield (region, func(region)) for each region, as the regions answer
+
+    Regions are queried concurrently by at most max_workers threads.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    regions = list(regions)
+    if not regions:
+        return
+    executor = ThreadPoolExecutor(min(max_workers or len(regions),
+                                      len(regions)))
+    try:
+        futures = dict((executor.submit(func, region), region)
+                       for region in regions)
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # don't hold up callers that stop early on the slower regions
+        executor.shutdown(wait=False)
+
+
+def get_running_instances(name, vpc_id=None, region=REGION, page_size=None,
+                          filters=None):
+    """Yield running instances tagged with name
+
+    :param string name: ec2 tag name used to discover instances
+    :param string vpc_id: only discover instances within this vpc
+    :param string region: name of the ec2 region to query
+    :param int page_size: stream instances a page of this many at a time,
+        fetching further pages only when the caller gets to them
+    :param dict filters: further ec2 filters instances must match, e.g.
+        from Filters.to_ec2()
+    """
+    filters = _running_filters(name, vpc_id, filters)
+    if page_size:
+        instances = _describe_instance_pages(filters, region, page_size)
+    else:
+        instances = _describe_instances(filters, region)
+    count = 0
+    for instance in instances:
+        count += 1
+        yield instance
+    instrumentation.observe('discovery.instances', count, tag=name)
+
+
+def get_running_instances_by_region(name, regions, vpc_id=None,
+                                    max_workers=None, page_size=None,
+                                    filters=None):
+    """Yield (region, instance) for running instances across regions
+
+    Regions are queried concurrently and their instances are yielded as soon
+    as each region answers.
+
+    :param string name: ec2 tag name used to discover instances
+    :param list regions: names of the ec2 regions to query
+    :param string vpc_id: only discover instances within this vpc
+    :param int max_workers: maximum number of regions queried at once
+    :param int page_size: number of instances requested at a time
+    :param dict filters: further ec2 filters instances must match
+    """
+    kwargs = {'filters': filters} if filters else {}
+
+    def discover(region):
+        return list(get_running_instances(name, vpc_id, region, page_size,
+                                          **kwargs))
+
+    for region, instances in _map_regions(discover, regions, max_workers):
+        for instance in instances:
+            yield region, instance
+
+
+def get_running_instances_by_tag(names, vpc_id=None, region=REGION,
+                                 filters=None):
+    """Return dict of each tag name to the running instances that carry it
+
+    All tags are discovered with a single ec2 request.
+
+    :param list names: ec2 tag names used to discover instances
+    :param string vpc_id: only discover instances within this vpc
+    :param string region: name of the ec2 region to query
+    :param dict filters: further ec2 filters instances must match
+    :rtype: dict
+    """
+    names = list(names)
+    grouped = dict((name, []) for name in names)
+    if not names:
+        return grouped
+    filters = _running_filters(names, vpc_id, filters)
+    for instance in _describe_instances(filters, region):
+        tags = getattr(instance, 'tags', None) or {}
+        for name in names:
+            if name in tags:
+                grouped[name].append(instance)
+    for name, instances in grouped.items():
+        instrumentation.observe('discovery.instances', len(instances),
+                                tag=name)
+    return grouped
+
+
+class DiscoveryCache(object):
+    """Bounded LRU cache of discovery results with stale-while-revalidate.
+
+    Entries younger than ``ttl`` seconds are returned as they are. Expired
+    entries are still returned straight away, but trigger a refresh in a
+    background thread; only one refresh per key runs at a time. Once more than
+    ``maxsize`` keys are held the least recently used one is evicted.
+    Results holding StaleInstances are stored already expired, so that the
+    next lookup tries to refresh them.
+    """
+
+    def __init__(self, ttl=60, maxsize=128, clock=time.time):
+        """
+
+        :param number ttl: seconds a result is considered fresh
+        :param int maxsize: maximum number of results held
+        :param callable clock: returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load):
+        """Return the result cached for key, calling load() on a miss
+
+        :param key: hashable cache key
+        :param callable load: returns the value to cache for key
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+        if entry is None:
+            instrumentation.increment('cache.misses')
+            value = load()
+            self.set(key, value, _is_stale(value))
+            return value
+        value, stored_at = entry
+        if self._clock() - stored_at >= self.ttl:
+            instrumentation.increment('cache.stale_hits')
+            self._revalidate(key, load)
+        else:
+            instrumentation.increment('cache.hits')
+        return value
+
+    def set(self, key, value, expired=False):
+        """Cache value for key
+
+        :param bool expired: store value as already expired, so that it is
+            returned but refreshed by the next lookup
+        """
+        stored_at = self._clock()
+        if expired:
+            stored_at -= self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, stored_at)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _revalidate(self, key, load):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        thread = threading.Thread(target=self._refresh, args=(key, load))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, key, load):
+        try:
+            value = load()
+            self.set(key, value, _is_stale(value))
+        except Exception:
+            # keep serving the stale value, the next lookup will retry
+            logger.exception('Could not refresh discovery cache for %r', key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class DiscoverySnapshot(object):
+    """Discovery results stored in a local file shared between processes.
+
+    Each entry records when it was written; entries older than ``max_age``
+    seconds are not fresh but can still be read back as a fallback when ec2
+    cannot be reached. The file is read through mmap and only re-parsed when
+    it changes, and is always replaced atomically so readers never see a
+    partial write.
+    """
+
+    def __init__(self, path, max_age=300, clock=time.time):
+        """
+
+        :param string path: location of the snapshot file
+        :param number max_age: seconds an entry is considered fresh
+        :param callable clock: returns the current time in seconds
+        """
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+        self._stat = None
+        self._data = {}
+
+    def read(self):
+        """Return every entry in the snapshot file"""
+        try:
+            with open(self.path, 'rb') as snapshot:
+                stat = os.fstat(snapshot.fileno())
+                stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+                if stat == self._stat:
+                    return self._data
+                data = {}
+                if stat[1]:
+                    mapped = mmap.mmap(snapshot.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                    try:
+                        data = json.loads(mapped[:].decode('utf-8'))
+                    finally:
+                        mapped.close()
+        except (IOError, OSError, ValueError):
+            return {}
+        self._stat, self._data = stat, data
+        return data
+
+    def get(self, key, max_age=None):
+        """Return InstanceRecords stored for key, or None when not fresh
+
+        :param key: json serialisable key
+        :param number max_age: override the snapshot's max_age, pass
+            float('inf') to accept entries of any age
+        """
+        entry = self.read().get(self._key(key))
+        if entry is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        if self._clock() - entry['updated'] > max_age:
+            return None
+        return [InstanceRecord(**record) for record in entry['instances']]
+
+    def write(self, key, instances):
+        """Store the Ec2Instances or InstanceRecords discovered for key"""
+        self.update({key: instances})
+
+    def update(self, entries):
+        """Store several keys' instances with a single write"""
+        with self._locked():
+            data = dict(self.read())
+            now = self._clock()
+            for key, instances in entries.items():
+                data[self._key(key)] = self._entry(instances, now)
+            self._replace(data)
+
+    def _key(self, key):
+        return json.dumps(key)
+
+    def _entry(self, instances, updated):
+        return {'updated': updated,
+                'instances': [instance.to_record().to_dict()
+                              for instance in instances]}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # serialise writers so that concurrent updates are not lost
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _replace(self, data):
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.caiman-')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(data, tmp, default=str)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class LatencyProbe(object):
+    """Chooses between addresses by how quickly they accept tcp connections.
+
+    Addresses are probed concurrently with a tcp connect to ``port``. Hosts
+    that do not accept within ``timeout`` seconds are unresponsive. Results
+    are reused for ``interval`` seconds.
+    """
+
+    def __init__(self, port, timeout=0.25, interval=30, max_workers=16,
+                 clock=time.time):
+        """
+
+        :param int port: port the service listens on
+        :param number timeout: seconds to wait for a connection
+        :param number interval: seconds probe results are reused for
+        :param int max_workers: maximum number of concurrent probes
+        :param callable clock: returns the current time in seconds
+        """
+        self.port = port
+        self.timeout = timeout
+        self.interval = interval
+        self.max_workers = max_workers
+        self._clock = clock
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def measure(self, address):
+        """Return seconds taken to connect to address, None if unresponsive"""
+        start = _timer()
+        try:
+            connection = socket.create_connection((address, self.port),
+                                                  self.timeout)
+        except (socket.error, socket.timeout, ValueError):
+            return None
+        latency = _timer() - start
+        connection.close()
+        return latency
+
+    def latencies(self, addresses):
+        """Return dict of each address to its latency or None
+
+        Only addresses without a result from the last interval are probed.
+        """
+        now = self._clock()
+        latencies = {}
+        with self._lock:
+            for address in addresses:
+                result = self._results.get(address)
+                if result is not None and now - result[1] < self.interval:
+                    latencies[address] = result[0]
+        stale = [address for address in addresses if address not in latencies]
+        if stale:
+            from concurrent.futures import ThreadPoolExecutor
+
+            workers = min(self.max_workers, len(stale))
+            with ThreadPoolExecutor(workers) as executor:
+                measured = dict(zip(stale, executor.map(self.measure, stale)))
+            with self._lock:
+                for address, latency in measured.items():
+                    self._results[address] = (latency, now)
+            latencies.update(measured)
+        return latencies
+
+    def fastest(self, addresses):
+        """Return the responsive address with the lowest latency
+
+        When no address responds the first one is returned, as it would be
+        without probing.
+        """
+        addresses = [address for address in addresses if address]
+        if not addresses:
+            return None
+        latencies = self.latencies(addresses)
+        responsive = [address for address in addresses
+                      if latencies.get(address) is not None]
+        if not responsive:
+            return addresses[0]
+        return min(responsive, key=latencies.get)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+class Watcher(object):
+    """Rediscovers instances in a background thread and reports changes.
+
+    Every ``interval`` seconds the current instances are compared, by
+    instance id, with the previous snapshot and each callback is called with
+    the sets of instances that were added and removed. The first snapshot
+    reports every instance as added.
+    """
+
+    def __init__(self, discover, interval=15):
+        """
+
+        :param callable discover: returns the currently running instances
+        :param number interval: seconds between refreshes
+        """
+        self.discover = discover
+        self.interval = interval
+        #: current instances by instance id
+        self.instances = None
+        self._callbacks = []
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_callback(self, on_change):
+        """Call on_change(added, removed) whenever the instances change
+
+        If a snapshot has already been taken, on_change is called straight
+        away with every current instance as added. Returns False, without
+        adding on_change, once the watcher has stopped.
+        """
+        with self._lock:
+            if self._stopped.is_set():
+                return False
+            self._callbacks.append(on_change)
+            if self.instances:
+                self._notify([on_change], set(self.instances.values()), set())
+            return True
+
+    def remove_callback(self, on_change):
+        """Stop calling on_change, stopping the watcher once it was the last
+        callback"""
+        with self._lock:
+            if on_change not in self._callbacks:
+                return
+            self._callbacks.remove(on_change)
+            if not self._callbacks:
+                # any refresh in progress finishes in the background
+                self._stopped.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stopped.is_set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self.interval)
+
+    def refresh(self):
+        """Take a new snapshot, notifying callbacks of any changes"""
+        try:
+            current = dict((instance.id, instance)
+                           for instance in self.discover())
+        except Exception:
+            logger.exception('Could not refresh watched instances')
+            return
+        with self._lock:
+            previous = self.instances or {}
+            added = set(current[id_] for id_ in set(current) - set(previous))
+            removed = set(previous[id_]
+                          for id_ in set(previous) - set(current))
+            self.instances = current
+            if added or removed:
+                self._notify(self._callbacks, added, removed)
+
+    def _notify(self, callbacks, added, removed):
+        for on_change in callbacks:
+            try:
+                on_change(added, removed)
+            except Exception:
+                logger.exception('Watcher callback %r failed', on_change)
+
+
+class Balancer(object):
+    """Spreads requests over the addresses discovered for a role.
+
+    Membership is kept up to date by a Watcher in the background, so
+    pick() never waits on ec2. Strategies are:
+
+        * ``round_robin``: each address in turn
+        * ``random``: any address at random
+        * ``power_of_two``: the less busy of two random addresses, going by
+          the in-flight counts callers report with started() and finished()
+    """
+
+    strategies = ('round_robin', 'random', 'power_of_two')
+
+    def __init__(self, running_instances, description,
+                 strategy='round_robin', interval=30, rng=None):
+        """
+
+        :param RunningInstances running_instances: used to watch the role
+        :param string description: description used to discover instances
+        :param string strategy: one of Balancer.strategies
+        :param number interval: seconds between membership refreshes
+        :param random.Random rng: source of randomness
+        """
+        if strategy not in self.strategies:
+            raise ValueError('Unknown balancing strategy {!r}, expected one '
+                             'of {}'.format(strategy,
+                                            ', '.join(self.strategies)))
+        if rng is None:
+            rng = random.Random()
+        self.strategy = strategy
+        self._random = rng
+        self._members = collections.OrderedDict()
+        self._inflight = collections.defaultdict(int)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.watcher = running_instances.watch(description, interval,
+                                               on_change=self._on_change)
+
+    def _on_change(self, added, removed):
+        with self._lock:
+            for instance in removed:
+                address = self._members.pop(instance.id, None)
+                self._inflight.pop(address, None)
+            for instance in added:
+                if instance.address:
+                    self._members[instance.id] = instance.address
+        self._ready.set()
+
+    @property
+    def addresses(self):
+        """Addresses currently being balanced over"""
+        with self._lock:
+            return list(self._members.values())
+
+    def wait(self, timeout=None):
+        """Wait until membership has been discovered, returning whether it
+        has"""
+        return self._ready.wait(timeout)
+
+    def pick(self, default=None):
+        """Return the address the next request should go to
+
+        :param default: returned when no addresses are known
+        """
+        addresses = self.addresses
+        if not addresses:
+            return default
+        if self.strategy == 'round_robin':
+            return addresses[next(self._counter) % len(addresses)]
+        if self.strategy == 'random' or len(addresses) == 1:
+            return self._random.choice(addresses)
+        first, second = self._random.sample(addresses, 2)
+        with self._lock:
+            if self._inflight[second] < self._inflight[first]:
+                return second
+            return first
+
+    def started(self, address):
+        """Report that a request to address has started"""
+        with self._lock:
+            self._inflight[address] += 1
+
+    def finished(self, address):
+        """Report that a request to address has finished"""
+        with self._lock:
+            if self._inflight.get(address):
+                self._inflight[address] -= 1
+
+    @contextlib.contextmanager
+    def request(self, default=None):
+        """Context manager picking an address and tracking it as in flight"""
+        address = self.pick(default)
+        if address is None:
+            yield address
+            return
+        self.started(address)
+        try:
+            yield address
+        finally:
+            self.finished(address)
+
+    def stop(self):
+        """Stop following membership changes, and stop the watcher when no
+        one else is following them"""
+        self.watcher.remove_callback(self._on_change)
+
+
+class InventoryIndex(object):
+    """In-memory index of every running instance, refreshed on a schedule.
+
+    The running instances of each region are fetched with one paginated,
+    unfiltered DescribeInstances scan and indexed by tag key, by the role and
+    environment of tags named by get_name, by vpc and by availability zone.
+    RunningInstances given an index answers every lookup from it instead of
+    making a request per tag. The first lookup scans if no scan has been
+    made yet; start() rescans every `interval` seconds in the background.
+    """
+
+    def __init__(self, regions=None, interval=300, page_size=1000,
+                 max_workers=None):
+        """
+
+        :param list regions: ec2 regions to index, defaults to REGION
+        :param number interval: seconds between scans once started
+        :param int page_size: instances fetched per request (5 to 1000)
+        :param int max_workers: maximum number of regions scanned at once
+        """
+        self.regions = list(regions) if regions is not None else [REGION]
+        self.interval = interval
+        self.page_size = page_size
+        self.max_workers = max_workers
+        #: time of the last completed scan
+        self.updated = None
+        self._indexes = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _scan(self, region):
+        return list(_describe_instance_pages(
+            {'instance-state-name': 'running'}, region, self.page_size))
+
+    def refresh(self):
+        """Scan every region and replace the indexes"""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        if len(self.regions) == 1:
+            scans = [(self.regions[0], self._scan(self.regions[0]))]
+        else:
+            scans = _map_regions(self._scan, self.regions, self.max_workers)
+        indexes = dict((index, collections.defaultdict(list)) for index in
+                       ('tag', 'role', 'environment', 'vpc', 'zone'))
+        count = 0
+        for region, instances in scans:
+            for instance in instances:
+                count += 1
+                pair = (region, instance)
+                environments = set()
+                for key in getattr(instance, 'tags', None) or {}:
+                    indexes['tag'][key].append(pair)
+                    name = parse_name(key)
+                    if name is not None:
+                        indexes['role'][name[0]].append(pair)
+                        environments.add(name[1])
+                for environment in environments:
+                    indexes['environment'][environment].append(pair)
+                indexes['vpc'][getattr(instance, 'vpc_id', None)].append(pair)
+                indexes['zone'][getattr(instance, 'placement', None)].append(
+                    pair)
+        self._indexes = dict((name, dict(index))
+                             for name, index in indexes.items())
+        self.updated = time.time()
+        instrumentation.observe('inventory.instances', count)
+
+    def _get(self, index, key):
+        """Return the (region, instance) pairs indexed under key"""
+        if self._indexes is None:
+            with self._lock:
+                if self._indexes is None:
+                    self._refresh()
+        return self._indexes[index].get(key, [])
+
+    def _tagged(self, name, vpc_id=None, regions=None, filters=None):
+        """Return (region, instance) pairs tagged with name, as discovery
+        with vpc_id, regions and Filters would find them"""
+        regions = regions or [REGION]
+        return [(region, instance)
+                for region, instance in self._get('tag', name)
+                if region in regions and
+                (not vpc_id or getattr(instance, 'vpc_id', None) == vpc_id) and
+                (not filters or filters.matches(instance))]
+
+    def _instances(self, index, key):
+        return [instance for _, instance in self._get(index, key)]
+
+    def by_tag(self, key):
+        """Return running instances carrying the tag key"""
+        return self._instances('tag', key)
+
+    def by_role(self, role, environment=None):
+        """Return running instances of role, in environment or in any"""
+        if environment is not None:
+            return self.by_tag(get_name(role, environment))
+        return self._instances('role', role)
+
+    def by_environment(self, environment):
+        """Return running instances with a role in environment"""
+        return self._instances('environment', environment)
+
+    def by_vpc(self, vpc_id):
+        """Return running instances in the vpc"""
+        return self._instances('vpc', vpc_id)
+
+    def by_zone(self, zone):
+        """Return running instances in the availability zone"""
+        return self._instances('zone', zone)
+
+    def start(self):
+        """Rescan every interval in a background thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stopped.is_set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Could not refresh the inventory index')
+            self._stopped.wait(self.interval)
+
+
+#: unix socket the discovery sidecar listens on. It is kept out of
+#: world-writable directories like /tmp, where any local user could listen
+#: first and answer with addresses of their choosing
+SIDECAR_SOCKET = os.environ.get('CAIMAN_SIDECAR',
+                                '/run/caiman/sidecar.sock')
+
+
+class SidecarClient(object):
+    """Asks a host-local caiman sidecar for discovered instances.
+
+    Requests and responses are single lines of json sent over a unix
+    socket, see caiman.sidecar.
+    """
+
+    def __init__(self, path=SIDECAR_SOCKET, timeout=5.0):
+        """
+
+        :param string path: unix socket the sidecar listens on
+        :param number timeout: seconds to wait for the sidecar to answer
+        """
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, message):
+        """Send message to the sidecar and return its response"""
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(self.timeout)
+            connection.connect(self.path)
+            connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            reader = connection.makefile('rb')
+            try:
+                line = reader.readline()
+            finally:
+                reader.close()
+        finally:
+            connection.close()
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError('caiman sidecar: {}'.format(response['error']))
+        return response
+
+    def lookup(self, names, address_attributes, vpc_id=None, regions=None,
+               filters=None):
+        """Return dict of each ec2 tag in names to its InstanceRecords"""
+        response = self.request({
+            'tags': list(names),
+            'attributes': list(address_attributes),
+            'vpc_id': vpc_id,
+            'regions': regions,
+            'filters': filters.to_ec2() if filters else None,
+        })
+        return dict((name, [InstanceRecord(**record) for record in records])
+                    for name, records in response['instances'].items())
+
+
+class _ContextLocal(object):
+    """Holds a value local to the current thread and asyncio task
+
+    contextvars is used where it is available, otherwise the value is local
+    to the thread only.
+    """
+
+    def __init__(self, name):
+        if contextvars is not None:
+            self._var = contextvars.ContextVar(name, default=None)
+        else:
+            self._local = threading.local()
+
+    def get(self):
+        if contextvars is not None:
+            return self._var.get()
+        return getattr(self._local, 'value', None)
+
+    def set(self, value):
+        if contextvars is not None:
+            self._var.set(value)
+        else:
+            self._local.value = value
+
+
+#: address lookup order overrides of the current context, by RunningInstances
+_address_lookup_orders = _ContextLocal('caiman_address_lookup_orders')
+
+
 class RunningInstances(object):
     """Discover running instances on ec2 by tag or by role."""
 
     _address_attributes = []
 
-    def __init__(self, environment_variable=None):
+    def __init__(self, environment_variable=None, vpc_id=None, cache=None,
+                 regions=None, max_workers=None, page_size=None,
+                 snapshot=None, records=False, probe=None, sidecar=None,
+                 inventory=None, filters=None, zone_affinity=False,
+                 breaker=None):
         """
 
         If an environment_variable is passed in, instances are discovered with
@@ -51,56 +1602,133 @@ class RunningInstances(object):
 
         :param string environment_variable: name of environment variable that
             denotes the current application enviroment (e.g.  demo, production)
+        :param string vpc_id: only discover instances within this vpc
+        :param DiscoveryCache cache: cache discovered instances instead of
+            querying ec2 on every lookup
+        :param list regions: ec2 regions to discover instances in, queried
+            concurrently. Defaults to REGION
+        :param int max_workers: maximum number of regions queried at once
+        :param int page_size: stream uncached instances from ec2 a page of
+            this many at a time (between 5 and 1000), so that first_address
+            returns once the first page arrives
+        :param DiscoverySnapshot snapshot: share discovered instances with
+            other processes through a local file, falling back to its
+            entries of any age when ec2 cannot be reached. Implies records,
+            as a snapshot only holds InstanceRecords
+        :param bool records: return compact InstanceRecords rather than
+            Ec2Instances wrapping boto instances
+        :param LatencyProbe probe: have first_address return the discovered
+            address that responds fastest, rather than the first one
+        :param sidecar: SidecarClient, or path of the unix socket of a caiman
+            sidecar, to ask for instances before making ec2 requests
+            directly. Lookups go straight to ec2 while it cannot be reached.
+            Implies records, as the sidecar answers with InstanceRecords
+        :param InventoryIndex inventory: answer lookups from this index of
+            the whole fleet rather than from ec2 or the sidecar
+        :param Filters filters: only discover instances meeting these
+            conditions, which ec2 applies before responding
+        :param zone_affinity: list instances in the same availability zone
+            first, addressing them by private ip address. True uses the
+            zone of local_zone(), or the name of a zone can be given
+        :param CircuitBreaker breaker: guard ec2 requests with this breaker,
+            answering with the last known good instances of a tag, marked
+            stale, while it is open or when ec2 fails. Uncached instances
+            are no longer streamed a page at a time
         """
         self.environment_variable = environment_variable
+        self.vpc_id = vpc_id
+        self.cache = cache
+        self.regions = list(regions) if regions is not None else None
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.snapshot = snapshot
+        # instances read back from a snapshot or answered by a sidecar can
+        # only be records, so freshly discovered ones are records too
+        self.records = (records or snapshot is not None or
+                        sidecar is not None)
+        self.probe = probe
+        if sidecar is not None and not hasattr(sidecar, 'lookup'):
+            sidecar = SidecarClient(sidecar)
+        self.sidecar = sidecar
+        self.inventory = inventory
+        self.filters = filters
+        self.zone_affinity = zone_affinity
+        self.breaker = breaker
+        #: (instances, time discovered) by cache key
+        self._last_good = {}
+        self._lookup_order_key = object()
+        self._watchers = {}
+        self._watchers_lock = threading.Lock()
 
     @classmethod
-    def address_order(cls, environment_variable=None, address_attributes=None):
+    def address_order(cls, environment_variable=None, address_attributes=None,
+                      **kwargs):
         """Alternate constructor that allows defining address preference
 
         :param address_attributes list: list of Ec2Instance attributes, used
         to determine the order in which addresses are used.
         """
-        instance = cls(environment_variable)
+        instance = cls(environment_variable, **kwargs)
         instance.address_attributes = address_attributes or []
         return instance
 
     def reset_address_lookup_order(self):
-        attrs = getattr(self, '_original_address_attributes', [])
-        self.address_attributes = attrs
+        """Go back to the shared address lookup order in the current thread
+        or asyncio task"""
+        self._override_address_lookup_order(None)
 
     def set_address_lookup_order(self, *args):
         """Set order Ec2Instance uses to determine instance address
 
+        The order only applies to lookups made from the current thread or
+        asyncio task, so a RunningInstances and its cache can be shared by
+        workers using different orders.
+
         :param args: list of strings that denote the attributes that
         Ec2Instance will use (in the order provided)
         """
         if not args:
             raise TypeError('{}() takes at least one argument (0 given)'
                             .format('set_address_lookup_order'))
-        self.address_attributes = list(args)
+        self._override_address_lookup_order(list(args))
 
     @contextlib.contextmanager
     def address_lookup_order(self, *args):
+        previous = (_address_lookup_orders.get() or {}).get(
+            self._lookup_order_key)
         self.set_address_lookup_order(*args)
-        yield
-        self.reset_address_lookup_order()
+        try:
+            yield
+        finally:
+            self._override_address_lookup_order(previous)
+
+    def _override_address_lookup_order(self, order):
+        # contexts can share the dict, so it is replaced rather than changed
+        orders = dict(_address_lookup_orders.get() or {})
+        if order is None:
+            orders.pop(self._lookup_order_key, None)
+        else:
+            orders[self._lookup_order_key] = order
+        _address_lookup_orders.set(orders)
 
     @property
     def address_attributes(self):
+        """Address lookup order of the current thread or asyncio task,
+        defaulting to the order shared by every thread"""
+        orders = _address_lookup_orders.get()
+        if orders and self._lookup_order_key in orders:
+            return orders[self._lookup_order_key]
         return self._address_attributes
 
     @address_attributes.setter  # noqa
     def address_attributes(self, value):
-        if not hasattr(self, '_original_address_attributes'):
-            self._original_address_attributes = self._address_attributes
         self._address_attributes = value
 
     def __call__(self, description):
         return self.get_instances(description)
 
-    def get_instances(self, description):
-        """Return generator of discovered ec2 instances
+    def get_tag(self, description):
+        """Return the ec2 tag used to discover instances for description
 
         :param string description: description used to discover instances
         """
@@ -112,11 +1740,275 @@ class RunningInstances(object):
                                  'undefined {} environment variable'
                                  .format(self.environment_variable))
             description = get_name(description, environment)
+        return description
+
+    @property
+    def zone(self):
+        """Availability zone instances are preferred in, or None"""
+        if self.zone_affinity is True:
+            return local_zone()
+        return self.zone_affinity or None
+
+    def get_instances(self, description):
+        """Return generator of discovered ec2 instances
+
+        :param string description: description used to discover instances
+        """
+        name = self.get_tag(description)
+        address_attributes = self.address_attributes
+        if self.cache is None and self.snapshot is None:
+            instances = self._discover(name, address_attributes)
+        else:
+            def load():
+                return self._load(name, address_attributes)
+            if self.cache is None:
+                instances = load()
+            else:
+                instances = self.cache.get(
+                    self._cache_key(name, address_attributes), load)
+        return iter(self._prefer_zone(instances))
+
+    def _prefer_zone(self, instances):
+        """Return instances with those in zone first, preferring their
+        private ip addresses"""
+        zone = self.zone
+        if not zone:
+            return instances
+        local, remote = [], []
+        for instance in instances:
+            if getattr(instance, 'placement', None) == zone:
+                local.append(instance.preferring('private_ip_address'))
+            else:
+                remote.append(instance)
+        return local + remote
+
+    def resolve_many(self, descriptions):
+        """Return dict of each description to its discovered ec2 instances
+
+        Every description that is not already cached is discovered with a
+        single ec2 request.
+
+        :param list descriptions: descriptions used to discover instances
+        :rtype: dict
+        """
+        return dict((description, self._prefer_zone(instances))
+                    for description, instances in
+                    self._resolve_many(descriptions).items())
+
+    def _resolve_many(self, descriptions):
+        address_attributes = self.address_attributes
+        results = {}
+        missing = {}
+        for description in descriptions:
+            name = self.get_tag(description)
+            key = self._cache_key(name, address_attributes)
+            if self.cache is not None and key in self.cache:
+                results[description] = list(self.cache.get(
+                    key, functools.partial(self._load, name,
+                                           address_attributes)))
+                continue
+            if self.snapshot is not None:
+                instances = self.snapshot.get(key)
+                if instances is not None:
+                    if self.cache is not None:
+                        self.cache.set(key, instances)
+                    results[description] = instances
+                    continue
+            missing[name] = description
+
+        if not missing:
+            return results
+        try:
+            found = self._discover_many(missing, address_attributes)
+        except Exception:
+            stale = self._stale_snapshot(missing, address_attributes)
+            if stale is None:
+                raise
+            for name, instances in stale.items():
+                results[missing[name]] = instances
+            return results
+
+        discovered = {}
+        for name, instances in found.items():
+            discovered[self._cache_key(name, address_attributes)] = instances
+            results[missing[name]] = instances
+        if self.cache is not None:
+            for key, instances in discovered.items():
+                self.cache.set(key, instances, _is_stale(instances))
+        if self.snapshot is not None:
+            self.snapshot.update(dict(
+                (key, instances) for key, instances in discovered.items()
+                if not _is_stale(instances)))
+        return results
+
+    def _load(self, name, address_attributes):
+        """Return list of instances from the snapshot or discovered on ec2"""
+        if self.snapshot is None:
+            return list(self._discover(name, address_attributes))
+
+        key = self._cache_key(name, address_attributes)
+        instances = self.snapshot.get(key)
+        if instances is not None:
+            return instances
+        try:
+            instances = list(self._discover(name, address_attributes))
+        except Exception:
+            stale = self._stale_snapshot([name], address_attributes)
+            if stale is None:
+                raise
+            return stale[name]
+        if not _is_stale(instances):
+            self.snapshot.write(key, instances)
+        return instances
+
+    def _stale_snapshot(self, names, address_attributes):
+        """Return dict of name to snapshot instances of any age, or None
+        unless every name has an entry"""
+        if self.snapshot is None:
+            return None
+        stale = {}
+        for name in names:
+            key = self._cache_key(name, address_attributes)
+            instances = self.snapshot.get(key, max_age=float('inf'))
+            if instances is None:
+                return None
+            stale[name] = instances
+        logger.warning('Could not discover %s, using snapshot from %s',
+                       ', '.join(names), self.snapshot.path)
+        return stale
+
+    def _discover_many(self, names, address_attributes):
+        """Return dict of each name to a list of its instances"""
+        found = self._discover_locally(names, address_attributes)
+        if found is not None:
+            return found
+        if self.breaker is not None:
+            return self._guarded(names, address_attributes,
+                                 lambda: self._discover_ec2_many(
+                                     names, address_attributes))
+        return self._discover_ec2_many(names, address_attributes)
+
+    def _discover_ec2_many(self, names, address_attributes):
+        return dict((name, [self._wrap(instance, address_attributes, region)
+                            for region, instance in pairs])
+                    for name, pairs in self._discover_tags(names).items())
+
+    def _guarded(self, names, address_attributes, discover):
+        """Return discover() called through the breaker, remembering its
+        result as last known good, or the last known good instances of
+        every name, marked stale, when the call is not made or fails"""
+        keys = dict((name, self._cache_key(name, address_attributes))
+                    for name in names)
+        try:
+            found = self.breaker.call(discover)
+        except Exception as error:
+            stale = {}
+            for name, key in keys.items():
+                last_good = self._last_good.get(key)
+                if last_good is None:
+                    raise
+                instances, updated = last_good
+                stale[name] = [StaleInstance(instance, updated)
+                               for instance in instances]
+            logger.warning('Could not discover %s (%s), using last known '
+                           'good instances', ', '.join(names), error)
+            instrumentation.increment('discovery.stale')
+            return stale
+        now = time.time()
+        for name, instances in found.items():
+            self._last_good[keys[name]] = (instances, now)
+        return found
+
+    def _discover_locally(self, names, address_attributes):
+        """Return dict of each name to its instances from the inventory or
+        the sidecar, or None when neither can answer"""
+        if self.inventory is None:
+            return self._ask_sidecar(names, address_attributes)
+        return dict((name, [self._wrap(instance, address_attributes, region)
+                            for region, instance in self.inventory._tagged(
+                                name, self.vpc_id, self.regions,
+                                self.filters)])
+                    for name in names)
+
+    def _ask_sidecar(self, names, address_attributes):
+        """Return dict of each name to InstanceRecords from the sidecar, or
+        None when there is no sidecar to ask"""
+        if self.sidecar is None:
+            return None
+        try:
+            return self.sidecar.lookup(names, address_attributes, self.vpc_id,
+                                       self.regions, self.filters)
+        except Exception as error:
+            logger.debug('Discovering without sidecar: %s', error)
+            return None
+
+    def _discover_tags(self, names):
+        """Return dict of each name to a list of (region, instance) pairs"""
+        kwargs = self._discovery_kwargs()
+        if self.regions is None:
+            found = get_running_instances_by_tag(list(names), **kwargs)
+            return dict((name, [(REGION, instance) for instance in instances])
+                        for name, instances in found.items())
+
+        def discover(region):
+            return get_running_instances_by_tag(list(names), region=region,
+                                                **kwargs)
+
+        merged = dict((name, []) for name in names)
+        for region, found in _map_regions(discover, self.regions,
+                                          self.max_workers):
+            for name, instances in found.items():
+                merged[name].extend((region, instance)
+                                    for instance in instances)
+        return merged
 
-        ec2_wrap = functools.partial(Ec2Instance,
-                                     address_attributes=self.address_attributes)
-        return (ec2_wrap(instance) for instance in
-                get_running_instances(description))
+    def _cache_key(self, name, address_attributes):
+        regions = tuple(self.regions) if self.regions is not None else None
+        key = (name, self.vpc_id, regions, tuple(address_attributes))
+        if self.filters:
+            key += (self.filters.key(), )
+        return key
+
+    def _discovery_kwargs(self):
+        kwargs = {}
+        if self.vpc_id:
+            kwargs['vpc_id'] = self.vpc_id
+        if self.filters:
+            kwargs['filters'] = self.filters.to_ec2()
+        return kwargs
+
+    def _discover(self, name, address_attributes):
+        found = self._discover_locally([name], address_attributes)
+        if found is not None:
+            return iter(found[name])
+        if self.breaker is not None:
+            found = self._guarded(
+                [name], address_attributes,
+                lambda: {name: list(self._discover_ec2(name,
+                                                       address_attributes))})
+            return iter(found[name])
+        return self._discover_ec2(name, address_attributes)
+
+    def _discover_ec2(self, name, address_attributes):
+        kwargs = self._discovery_kwargs()
+        if self.page_size:
+            kwargs['page_size'] = self.page_size
+        if self.regions is None:
+            pairs = ((REGION, instance) for instance in
+                     get_running_instances(name, **kwargs))
+        else:
+            pairs = get_running_instances_by_region(
+                name, self.regions, max_workers=self.max_workers, **kwargs)
+        return (self._wrap(instance, address_attributes, region)
+                for region, instance in pairs)
+
+    def _wrap(self, instance, address_attributes, region_name):
+        with instrumentation.timer('discovery.wrap_seconds'):
+            if self.records:
+                return InstanceRecord.from_instance(
+                    instance, address_attributes, region_name)
+            return Ec2Instance(instance, address_attributes=address_attributes,
+                               region_name=region_name)
 
     def addresses(self, description):
         """
@@ -130,11 +2022,120 @@ class RunningInstances(object):
         """
         Return the 1st discovered address.
 
+        With a probe, the discovered address that responds fastest is
+        returned instead.
+
         :param string description: description used to discover instances
         :param string default: fallback value used when no instances can be found
         :rtype: string
         """
-        return next(self.addresses(description), default)
+        if self.probe is None:
+            return next(self.addresses(description), default)
+        fastest = self.probe.fastest(self.addresses(description))
+        return default if fastest is None else fastest
+
+    def watch(self, description, interval=15, on_change=None):
+        """Watch the instances for description in a background thread
+
+        Only one watcher runs per description; further calls add their
+        callback to it. Instances are always discovered from ec2, bypassing
+        any cache.
+
+        :param string description: description used to discover instances
+        :param number interval: seconds between refreshes
+        :param callable on_change: called with the sets of added and removed
+            Ec2Instances whenever they change
+        :rtype: Watcher
+        """
+        name = self.get_tag(description)
+        address_attributes = self.address_attributes
+        with self._watchers_lock:
+            watcher = self._watchers.get(name)
+            # watchers stop once their last callback is removed
+            if watcher is not None and not watcher.running:
+                watcher = None
+            if (watcher is not None and on_change is not None and
+                    not watcher.add_callback(on_change)):
+                watcher = None
+            if watcher is None:
+                watcher = Watcher(
+                    lambda: self._discover(name, address_attributes),
+                    interval)
+                self._watchers[name] = watcher
+                if on_change is not None:
+                    watcher.add_callback(on_change)
+                watcher.start()
+        return watcher
+
+    def unwatch(self, description):
+        """Stop watching the instances for description"""
+        with self._watchers_lock:
+            watcher = self._watchers.pop(self.get_tag(description), None)
+        if watcher is not None:
+            watcher.stop()
+
+
+#: outcome of warm: the RunningInstances warmed, dict of each resolved role
+#: to its instances, and list of the roles that were not resolved in time
+Warmup = collections.namedtuple('Warmup',
+                                'running_instances resolved unresolved')
+
+
+def warm(roles, environment_variable=None, timeout=None,
+         running_instances=None, **kwargs):
+    """Discover the instances of roles concurrently, e.g. before serving
+
+    Each role is looked up in its own background thread, so that the
+    running_instances cache is filled by the time the application needs it.
+    Returns once every role is resolved or timeout seconds have passed,
+    whichever comes first. Lookups still running carry on in the background
+    and fill the cache when they finish.
+
+    :param list roles: descriptions used to discover instances
+    :param string environment_variable: name of environment variable that
+        denotes the current application enviroment (e.g.  demo, production)
+    :param number timeout: seconds to wait, None waits for every role
+    :param RunningInstances running_instances: to warm, instead of a new
+        RunningInstances(environment_variable, cache=DiscoveryCache(),
+        **kwargs)
+    :rtype: Warmup
+    """
+    roles = list(roles)
+    if running_instances is None:
+        kwargs.setdefault('cache', DiscoveryCache())
+        running_instances = RunningInstances(environment_variable, **kwargs)
+    results = queue.Queue()
+
+    def resolve(role):
+        try:
+            results.put((role, list(running_instances.get_instances(role)),
+                         None))
+        except Exception as error:
+            results.put((role, None, error))
+
+    for role in roles:
+        thread = threading.Thread(target=resolve, args=(role, ),
+                                  name='caiman-warm-{}'.format(role))
+        thread.daemon = True
+        thread.start()
+
+    deadline = None if timeout is None else _timer() + timeout
+    resolved = {}
+    for _ in roles:
+        try:
+            wait = None if deadline is None else max(0, deadline - _timer())
+            role, instances, error = results.get(True, wait)
+        except queue.Empty:
+            break
+        if error is None:
+            resolved[role] = instances
+        else:
+            logger.warning('Could not resolve %s: %s', role, error)
+    unresolved = [role for role in roles if role not in resolved]
+    if unresolved:
+        logger.warning('Not resolved within %s seconds: %s', timeout,
+                       ', '.join(unresolved))
+    return Warmup(running_instances, resolved, unresolved)
 
 
 class Ec2Instance(object):
@@ -147,10 +2148,14 @@ class Ec2Instance(object):
         * private_ip_address
     """
     address_attributes = ['publicIp', 'public_dns_name', 'private_ip_address']
+    #: discovered by the latest lookup, see StaleInstance
+    stale = False
 
-    def __init__(self, instance, address_attributes=None):
+    def __init__(self, instance, address_attributes=None, region_name=None):
         #: wrapped ec2instance
         self.instance = instance
+        #: name of the region the instance was discovered in
+        self.region_name = region_name
         self._address = None
         if address_attributes:
             self.address_attributes = address_attributes
@@ -159,6 +2164,7 @@ class Ec2Instance(object):
     def address(self):
         """Address of wrapped ec2instance"""
         if not self._address:
+            start = _timer()
             attrs = self.address_attributes
 
             # build up an interable of all attributes that exist and are
@@ -168,6 +2174,8 @@ class Ec2Instance(object):
 
             # only need the 1st value
             self._address = next(options, None)
+            instrumentation.observe('discovery.address_seconds',
+                                    _timer() - start)
         return self._address
 
     def __getattr__(self, name):
@@ -176,6 +2184,132 @@ class Ec2Instance(object):
     def __repr__(self):
         return self.address if self.address is not None else repr(self.instance)
 
+    def preferring(self, attribute):
+        """Return a copy addressed by attribute, when the instance has it"""
+        attrs = [attribute] + [name for name in self.address_attributes
+                               if name != attribute]
+        return Ec2Instance(self.instance, attrs, self.region_name)
+
+    def to_record(self):
+        """Return an InstanceRecord copy of the wrapped ec2instance"""
+        return InstanceRecord.from_instance(self.instance,
+                                            self.address_attributes,
+                                            self.region_name)
+
+
+class InstanceRecord(object):
+    """Compact copy of the parts of an ec2instance that caiman uses.
+
+    Only the id, tags, placement, state and address attributes are kept and
+    the address is worked out up front, so no boto objects are kept alive
+    by caches holding records. The private ip address is always kept, for
+    preferring it within the same availability zone. Address attributes can
+    be read as attributes of the record, as they can on an Ec2Instance.
+    """
+    __slots__ = ('id', 'tags', 'placement', 'state', 'region_name',
+                 'address', 'attributes')
+    #: discovered by the latest lookup, see StaleInstance
+    stale = False
+
+    def __init__(self, id, tags=None, placement=None, state=None,
+                 region_name=None, address=None, attributes=None):
+        self.id = id
+        self.tags = tags or {}
+        self.placement = placement
+        self.state = state
+        self.region_name = region_name
+        self.address = address
+        #: values of the address attributes by name
+        self.attributes = attributes or {}
+
+    @classmethod
+    def from_instance(cls, instance, address_attributes=None,
+                      region_name=None):
+        """Alternate constructor copying a boto ec2instance
+
+        :param instance: boto ec2instance
+        :param list address_attributes: attributes used to determine the
+            address, in order of preference. Defaults to those of Ec2Instance
+        :param string region_name: region the instance was discovered in
+        """
+        wrapped = Ec2Instance(instance, address_attributes, region_name)
+        names = list(wrapped.address_attributes) + ['private_ip_address']
+        attributes = dict((name, getattr(instance, name, None))
+                          for name in names)
+        return cls(getattr(instance, 'id', None),
+                   dict(getattr(instance, 'tags', None) or {}),
+                   getattr(instance, 'placement', None),
+                   getattr(instance, 'state', None),
+                   region_name,
+                   wrapped.address,
+                   attributes)
+
+    def to_record(self):
+        return self
+
+    def preferring(self, attribute):
+        """Return a copy addressed by attribute, when the record has it"""
+        address = self.attributes.get(attribute)
+        if not address or address == self.address:
+            return self
+        record = InstanceRecord(**self.to_dict())
+        record.address = address
+        return record
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __getattr__(self, name):
+        # only called for names that are not slots
+        if name != 'attributes':
+            try:
+                return self.attributes[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    def __repr__(self):
+        if self.address is not None:
+            return self.address
+        return 'InstanceRecord:{}'.format(self.id)
+
+
+class StaleInstance(object):
+    """Last known good instance returned while ec2 could not be used.
+
+    Reads as the Ec2Instance or InstanceRecord it wraps, with ``stale`` set
+    and ``updated`` holding the time it was discovered.
+    """
+
+    stale = True
+
+    def __init__(self, instance, updated):
+        #: wrapped Ec2Instance or InstanceRecord
+        self.instance = instance
+        #: time.time() the instance was discovered
+        self.updated = updated
+
+    @property
+    def age(self):
+        """Seconds since the instance was discovered"""
+        return time.time() - self.updated
+
+    def preferring(self, attribute):
+        return StaleInstance(self.instance.preferring(attribute), self.updated)
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def __repr__(self):
+        return repr(self.instance)
+
+
+def _is_stale(instances):
+    """Whether a discovery result holds StaleInstances"""
+    if not isinstance(instances, list):
+        return False
+    return any(getattr(instance, 'stale', False) for instance in instances)
+
 
 LOGLEVEL = 'DEBUG' if os.environ.get('SOMA_ENVIRONMENT', '') == 'demo' else 'ERROR'
 DEFAULT_LOGGING = {
@@ -212,21 +2346,309 @@ DEFAULT_LOGGING = {
 }
 
 
-def add_remote_logger(remote_logger, logger_name, log_config):
+def _resolve(name):
+    """Return the object named by a dotted name, e.g. graypy.GELFHandler"""
+    module, attribute = name.rsplit('.', 1)
+    return getattr(__import__(module, fromlist=[attribute]), attribute)
+
+
+class BufferedHandler(logging.Handler):
+    """Hands log records to another handler on a background thread.
+
+    Logging calls only put the record on a bounded queue, so a slow or
+    unreachable log server never holds up the application. The background
+    thread sends records to the wrapped handler in batches of up to
+    `batch_size`. When the queue is full, records are dropped, or with
+    `block` the logging call waits up to `timeout` seconds for room.
+    Closing the handler, which logging does at exit, sends the records still
+    queued.
+
+    The wrapped handler can be given by its class name along with its
+    arguments, so that it can be used from a log config::
+
+        'graypy': {
+            'class': 'caiman.BufferedHandler',
+            'handler': 'graypy.GELFHandler',
+            'host': '10.0.1.12',
+            'port': 12201,
+        }
+    """
+
+    def __init__(self, handler, capacity=1000, batch_size=100, block=False,
+                 timeout=None, shutdown_timeout=5.0, **handler_kwargs):
+        """
+
+        :param handler: logging.Handler to send records with, or the dotted
+            name of its class
+        :param int capacity: most records queued before dropping or blocking
+        :param int batch_size: most records sent at once
+        :param bool block: wait for room instead of dropping records
+        :param float timeout: seconds to wait for room, None waits forever
+        :param float shutdown_timeout: seconds close waits to send the
+            records still queued
+        """
+        logging.Handler.__init__(self)
+        if not isinstance(handler, logging.Handler):
+            handler = _resolve(handler)(**handler_kwargs)
+        self.target = handler
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.block = block
+        self.timeout = timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(capacity)
+        self._thread = None
+        self._pid = None
+        self._worker_lock = threading.Lock()
+        #: held while a batch is sent, so the target is not replaced midway
+        self._send_lock = threading.RLock()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def _start(self):
+        with self._worker_lock:
+            if self._pid != os.getpid():
+                # the worker thread does not survive a fork and the parent
+                # sends the records it had queued itself
+                self._queue = queue.Queue(self.capacity)
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='caiman-log-sender')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def emit(self, record):
+        if self._thread is None or self._pid != os.getpid():
+            self._start()
+        try:
+            # args may be changed by the caller after it logs
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+            self._queue.put(record, self.block, self.timeout)
+        except queue.Full:
+            self.dropped += 1
+            instrumentation.increment('logging.dropped')
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < self.batch_size and records[-1] is not None:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.send([record for record in records if record is not None])
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+            if records[-1] is None:
+                return
+
+    def send(self, records):
+        """Send a batch of records with the wrapped handler"""
+        with self._send_lock:
+            target = self.target
+            target.acquire()
+            try:
+                for record in records:
+                    if target.filter(record):
+                        try:
+                            target.emit(record)
+                        except Exception:
+                            target.handleError(record)
+            finally:
+                target.release()
+
+    def flush(self, timeout=None):
+        """Wait up to timeout seconds for the queued records to be sent"""
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        deadline = _timer() + timeout
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks and _timer() < deadline:
+                done.wait(deadline - _timer())
+        self.target.flush()
+
+    def close(self):
+        thread, self._thread = self._thread, None
+        if thread is not None and self._pid == os.getpid():
+            try:
+                self._queue.put(None, True, self.shutdown_timeout)
+            except queue.Full:
+                pass
+            thread.join(self.shutdown_timeout)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class RemoteLoggerHandler(BufferedHandler):
+    """Sends log records to a logger server found by role in the background.
+
+    Records are queued as soon as the handler is created, as they are by
+    BufferedHandler, while the instances of `role` are watched in a
+    background thread. Once one is found a handler for its address is
+    created and the queue drains to it. The address is replaced when its
+    instance goes away or when sending to it fails. It can be named in a log
+    config in place of a graypy handler::
+
+        'graypy': {
+            'class': 'caiman.RemoteLoggerHandler',
+            'role': 'logger',
+            'environment_variable': 'SOMA_ENVIRONMENT',
+        }
+    """
+
+    def __init__(self, role='logger', environment_variable=None,
+                 handler='graypy.GELFHandler', port=12201, interval=60,
+                 running_instances=None, capacity=1000, batch_size=100,
+                 block=False, timeout=None, shutdown_timeout=5.0,
+                 **handler_kwargs):
+        """
+
+        :param string role: description used to discover logger servers
+        :param string environment_variable: name of environment variable that
+            denotes the current application enviroment (e.g.  demo, production)
+        :param handler: class, or dotted name of the class, of the handler
+            records are sent with. It is called with host, port and
+            handler_kwargs
+        :param int port: port of the logger server
+        :param number interval: seconds between rediscovering logger servers
+        :param RunningInstances running_instances: used to watch the role,
+            instead of RunningInstances(environment_variable)
+
+        The other arguments are those of BufferedHandler.
+        """
+        BufferedHandler.__init__(self, NullHandler(), capacity, batch_size,
+                                 block, timeout, shutdown_timeout)
+        if not callable(handler):
+            handler = _resolve(handler)
+        self.handler_class = handler
+        self.port = port
+        self.handler_kwargs = handler_kwargs
+        #: address records are currently sent to
+        self.host = None
+        self._members = collections.OrderedDict()
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._resolved = threading.Event()
+        self._closing = threading.Event()
+        self.role = role
+        #: created by, and so watched only for, this handler
+        self._running_instances = None
+        if running_instances is None:
+            running_instances = RunningInstances(environment_variable)
+            self._running_instances = running_instances
+        self.watcher = running_instances.watch(role, interval,
+                                               on_change=self._on_change)
+
+    def _on_change(self, added, removed):
+        with self._lock:
+            for instance in removed:
+                self._members.pop(instance.id, None)
+            for instance in added:
+                if instance.address:
+                    self._members[instance.id] = instance.address
+            if self.host not in self._members.values():
+                self._switch()
+
+    def _switch(self, exclude=None):
+        """Send records to another known address, preferably not exclude"""
+        addresses = list(self._members.values())
+        candidates = [address for address in addresses if address != exclude]
+        host = next(iter(candidates or addresses), None)
+        if host is None:
+            self.host = None
+            self._resolved.clear()
+            return
+        if host == self.host:
+            return
+        target = self.handler_class(host=host, port=self.port,
+                                    **self.handler_kwargs)
+        target.handleError = self._send_failed
+        if self.formatter is not None:
+            target.setFormatter(self.formatter)
+        # waits for the batch being sent to the previous target
+        with self._send_lock:
+            previous, self.target, self.host = self.target, target, host
+        previous.close()
+        self._resolved.set()
+        logger.debug('Sending log records to %s', host)
+
+    def _send_failed(self, record):
+        self._failures += 1
+
+    def send(self, records):
+        while not self._resolved.wait(1):
+            if self._closing.is_set():
+                return
+        with self._send_lock:
+            self._failures = 0
+            host = self.host
+            BufferedHandler.send(self, records)
+        if self._failures:
+            self.watcher.refresh()
+            with self._lock:
+                self._switch(exclude=host)
+
+    def flush(self, timeout=None):
+        # nothing can be sent until a logger server has been found
+        if self._resolved.is_set():
+            BufferedHandler.flush(self, timeout)
+
+    def close(self):
+        self._closing.set()
+        # the watcher stops once no one else follows the role
+        self.watcher.remove_callback(self._on_change)
+        if self._running_instances is not None:
+            self._running_instances.unwatch(self.role)
+        BufferedHandler.close(self)
+
+
+def add_remote_logger(remote_logger, logger_name, log_config, buffered=False,
+                      role=None, **buffer_options):
     """Returns log_config after adding a graypy handler
 
     :param string remote_logger: The ip or hostname of a logger server
     :param string logger_name: The name of logger to which we add the graypy handler
     :param dict log_config: A pre-existing log_config dict to add the handler to
+    :param bool buffered: send records from a background thread through a
+        BufferedHandler, which buffer_options are passed to
+    :param string role: find the logger server by this role in the
+        background with a RemoteLoggerHandler, which buffer_options are
+        passed to, instead of sending to remote_logger
     :rtype: dict
     """
-    if remote_logger:
-        log_config['handlers']['graypy'] = {
+    if role:
+        handler = {
+            'class': 'caiman.RemoteLoggerHandler',
+            'role': role,
+            'port': 12201,
+        }
+        handler.update(buffer_options)
+    elif remote_logger:
+        handler = {
             'class': 'graypy.GELFHandler',
             'host': remote_logger,
             'port': 12201,
         }
-        log_config['loggers'][logger_name]['handlers'].append('graypy')
+        if buffered:
+            handler['handler'] = handler.pop('class')
+            handler['class'] = 'caiman.BufferedHandler'
+            handler.update(buffer_options)
+    else:
+        return log_config
+    log_config['handlers']['graypy'] = handler
+    log_config['loggers'][logger_name]['handlers'].append('graypy')
     return log_config
 
 # Deprecated functions. To be deleted once client code that uses them is
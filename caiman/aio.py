@@ -0,0 +1,99 @@
+"""Asyncio flavoured discovery of running ec2 instances.
+
+boto is blocking, so lookups run in an executor while the event loop carries
+on; a semaphore bounds how many of them are in flight at once::
+
+    >>> running_instances = AsyncRunningInstances('SOMA_ENVIRONMENT')
+    >>> logger, database = await asyncio.gather(
+    ...     running_instances.first_address('logger'),
+    ...     running_instances.first_address('database'))
+"""
+import asyncio
+import functools
+import contextvars
+
+from caiman import RunningInstances
+
+
+class AsyncRunningInstances(RunningInstances):
+    """Discover running instances on ec2 by tag or by role, from asyncio code.
+
+    Tag resolution and address ordering behave exactly as they do for
+    RunningInstances; the lookup methods are coroutines returning lists
+    instead of generators.
+    """
+
+    def __init__(self, environment_variable=None, max_concurrency=8,
+                 executor=None, **kwargs):
+        """
+
+        :param string environment_variable: name of environment variable that
+            denotes the current application enviroment (e.g.  demo, production)
+        :param int max_concurrency: maximum number of concurrent ec2 lookups
+        :param executor: concurrent.futures executor lookups run in, defaults
+            to the event loop's default executor
+        """
+        super().__init__(environment_variable, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created lazily so that it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # run in the task's context so that its address lookup order applies
+        context = contextvars.copy_context()
+        async with self.semaphore:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(context.run, func, *args))
+
+    def __call__(self, description):
+        return self.get_instances(description)
+
+    async def get_instances(self, description):
+        """Return list of discovered ec2 instances
+
+        :param string description: description used to discover instances
+        """
+        sync_get_instances = super().get_instances
+        return await self._run(
+            lambda: list(sync_get_instances(description)))
+
+    async def addresses(self, description):
+        """
+        Return list of the address of each discovered instance.
+
+        :param string description: description used to discover instances
+        """
+        return [host.address for host in await self.get_instances(description)]
+
+    async def first_address(self, description, default=''):
+        """
+        Return the 1st discovered address.
+
+        :param string description: description used to discover instances
+        :param string default: fallback value used when no instances can be
+            found
+        :rtype: string
+        """
+        addresses = await self.addresses(description)
+        if self.probe is None:
+            return next(iter(addresses), default)
+        fastest = await self._run(self.probe.fastest, addresses)
+        return default if fastest is None else fastest
+
+    async def resolve_many(self, descriptions):
+        """Return dict of each description to its discovered ec2 instances
+
+        Uses a single ec2 request, see RunningInstances.resolve_many.
+
+        :param list descriptions: descriptions used to discover instances
+        :rtype: dict
+        """
+        return await self._run(super().resolve_many, list(descriptions))
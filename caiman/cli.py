@@ -0,0 +1,162 @@
+"""Command line discovery of running ec2 instances.
+
+Every role given is resolved with a single ec2 request and the results are
+kept in a local cache file for ``--ttl`` seconds, so that scripts and cron
+jobs calling caiman repeatedly do not each make their own requests::
+
+    $ caiman addresses logger database --env-var SOMA_ENVIRONMENT
+    10.0.1.12
+    10.0.2.31
+    10.0.2.32
+
+    $ caiman addresses logger database --env-var SOMA_ENVIRONMENT --format json
+    {"database": ["10.0.2.31", "10.0.2.32"], "logger": ["10.0.1.12"]}
+
+The exit status is 1 when no running instance was found for a role and 2
+when discovery failed.
+
+``caiman sidecar`` runs the host-local discovery sidecar, see caiman.sidecar.
+"""
+import os
+import sys
+import json
+import argparse
+
+import caiman
+
+#: where discovery results are cached unless --cache is given
+CACHE_PATH = os.path.join('~', '.cache', 'caiman', 'discovery.json')
+
+
+def parser():
+    parser = argparse.ArgumentParser(
+        prog='caiman', description='Discover running ec2 instances.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    discovery = argparse.ArgumentParser(add_help=False)
+    discovery.add_argument('--env-var', metavar='NAME',
+                           help='environment variable naming the '
+                                'application environment, e.g. '
+                                'SOMA_ENVIRONMENT')
+    discovery.add_argument('--vpc-id', help='only instances in this vpc')
+    discovery.add_argument('--region', action='append', dest='regions',
+                           metavar='REGION',
+                           help='region to search, may be repeated '
+                                '(default {})'.format(caiman.REGION))
+    discovery.add_argument('--filter', action='append', dest='filters',
+                           default=[], metavar='NAME=VALUE',
+                           help='ec2 filter instances must match, one of '
+                                'availability-zone, instance-type, '
+                                'subnet-id, vpc-id or tag:<key>, may be '
+                                'repeated')
+
+    addresses = commands.add_parser(
+        'addresses', parents=[discovery],
+        help='print the addresses of the instances of roles')
+    addresses.add_argument('roles', nargs='+', metavar='role',
+                           help='role, or whole ec2 tag without --env-var')
+    addresses.add_argument('--first', action='store_true',
+                           help='only the first address of each role')
+    addresses.add_argument('--format', choices=('lines', 'json'),
+                           default='lines',
+                           help='one address per line, or a json object of '
+                                'role to addresses (default lines)')
+    addresses.add_argument('--cache', metavar='PATH', default=CACHE_PATH,
+                           help='file results are cached in '
+                                '(default {})'.format(CACHE_PATH))
+    addresses.add_argument('--ttl', type=float, default=60,
+                           help='seconds cached results are used for, 0 '
+                                'disables the cache (default 60)')
+
+    sidecar = commands.add_parser(
+        'sidecar', parents=[discovery],
+        help='answer discovery requests of the processes on this host')
+    sidecar.add_argument('roles', nargs='*', metavar='role',
+                         help='role, or whole ec2 tag without --env-var, '
+                              'to discover on startup')
+    sidecar.add_argument('--socket', default=caiman.SIDECAR_SOCKET,
+                         help='unix socket to listen on '
+                              '(default {})'.format(caiman.SIDECAR_SOCKET))
+    sidecar.add_argument('--interval', type=float, default=30,
+                         help='seconds between rediscovering instances '
+                              '(default 30)')
+    return parser
+
+
+def _snapshot(path, ttl):
+    if not ttl:
+        return None
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return caiman.DiscoverySnapshot(path, max_age=ttl)
+
+
+def addresses(args):
+    """Return dict of each role in args to its addresses"""
+    running_instances = caiman.RunningInstances(
+        args.env_var, vpc_id=args.vpc_id, regions=args.regions,
+        snapshot=_snapshot(args.cache, args.ttl), records=True,
+        filters=caiman.Filters.parse(args.filters) or None)
+    instances = running_instances.resolve_many(args.roles)
+    return dict((role, [instance.address for instance in instances[role]
+                        if instance.address])
+                for role in args.roles)
+
+
+def sidecar(args, err=sys.stderr):
+    """Run the discovery sidecar until interrupted"""
+    from caiman.sidecar import Sidecar
+
+    running_instances = caiman.RunningInstances(args.env_var)
+    tags = [running_instances.get_tag(role) for role in args.roles]
+    server = Sidecar(args.socket, args.interval)
+    if tags:
+        try:
+            server.lookup(tags, running_instances.address_attributes,
+                          args.vpc_id, args.regions,
+                          caiman.Filters.parse(args.filters).to_ec2())
+        except Exception as error:
+            err.write('caiman: {}\n'.format(error))
+    try:
+        server.serve_forever()
+    except Exception as error:
+        err.write('caiman: {}\n'.format(error))
+        return 2
+    return 0
+
+
+def main(argv=None, out=sys.stdout, err=sys.stderr):
+    args = parser().parse_args(argv)
+    if args.command == 'sidecar':
+        return sidecar(args, err)
+    try:
+        found = addresses(args)
+    except Exception as error:
+        err.write('caiman: {}\n'.format(error))
+        return 2
+
+    status = 0
+    for role in args.roles:
+        if not found[role]:
+            err.write('caiman: no running instances for {}\n'.format(role))
+            status = 1
+        if args.first:
+            found[role] = next(iter(found[role]), None)
+
+    if args.format == 'json':
+        json.dump(found, out, sort_keys=True)
+        out.write('\n')
+    else:
+        for role in args.roles:
+            role_addresses = [found[role]] if args.first else found[role]
+            for address in role_addresses:
+                if address is not None:
+                    out.write(address + '\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Host-local discovery sidecar.
+
+A single sidecar process per host makes the ec2 requests that every process
+on the host would otherwise make on its own. It keeps what it has discovered
+in memory, rediscovers every tag it has been asked about each `interval`
+seconds in the background, and answers over a unix socket::
+
+    $ caiman sidecar --env-var SOMA_ENVIRONMENT logger database
+
+Processes use it by passing `sidecar` to RunningInstances, and discover
+directly from ec2 whenever the sidecar is not running::
+
+    >>> running_instances = RunningInstances('SOMA_ENVIRONMENT',
+    ...                                      sidecar=caiman.SIDECAR_SOCKET)
+
+Each request is a line of json naming the ec2 tags wanted along with the
+client's address attributes, vpc, regions and ec2 filters::
+
+    {"tags": ["soma-demo-logger"], "attributes": [], "vpc_id": null,
+     "regions": null, "filters": {"availability-zone": "eu-west-1a"}}
+
+and is answered with a line of json holding the InstanceRecords of each tag,
+or the error that prevented discovering them::
+
+    {"instances": {"soma-demo-logger": [{"id": "i-4ae04800", ...}]}}
+    {"error": "..."}
+"""
+import os
+import json
+import stat
+import socket
+import logging
+import threading
+
+try:
+    import socketserver
+except ImportError:  # NOQA
+    import SocketServer as socketserver
+
+import caiman
+
+logger = logging.getLogger(__name__)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                found = self.server.sidecar.lookup(
+                    request['tags'], request.get('attributes') or [],
+                    request.get('vpc_id'), request.get('regions'),
+                    request.get('filters'))
+                response = {'instances': dict(
+                    (name, [record.to_dict() for record in records])
+                    for name, records in found.items())}
+            except Exception as error:
+                logger.exception('Could not answer %r', line)
+                response = {'error': str(error)}
+            self.wfile.write(json.dumps(response, default=str)
+                             .encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class Sidecar(object):
+    """Discovers instances for the processes of a host and answers them
+    over a unix socket.
+    """
+
+    def __init__(self, path=caiman.SIDECAR_SOCKET, interval=30):
+        """
+
+        :param string path: unix socket to listen on
+        :param number interval: seconds between rediscovering every tag
+            asked about
+        """
+        self.path = path
+        self.interval = interval
+        self._instances = {}
+        #: (RunningInstances, tag, address attributes) of each key asked for
+        self._watched = {}
+        self._running_instances = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+        self._threads = []
+
+    def _discoverer(self, vpc_id, regions, filters):
+        """RunningInstances discovering whole tags in vpc_id and regions
+        meeting the ec2 filters"""
+        filters = caiman.Filters.from_ec2(filters or {})
+        key = (vpc_id, tuple(regions) if regions is not None else None,
+               filters.key())
+        with self._lock:
+            running_instances = self._running_instances.get(key)
+            if running_instances is None:
+                running_instances = caiman.RunningInstances(
+                    vpc_id=vpc_id, regions=regions, records=True,
+                    filters=filters or None)
+                self._running_instances[key] = running_instances
+            return running_instances
+
+    def lookup(self, names, address_attributes, vpc_id=None, regions=None,
+               filters=None):
+        """Return dict of each ec2 tag in names to its InstanceRecords
+
+        Tags that have not been asked about before are discovered with a
+        single ec2 request, and rediscovered every interval from then on.
+
+        :param dict filters: ec2 filters, as returned by Filters.to_ec2
+        """
+        running_instances = self._discoverer(vpc_id, regions, filters)
+        keys = dict((name, running_instances._cache_key(name,
+                                                        address_attributes))
+                    for name in names)
+        with self._lock:
+            found = dict((name, self._instances[key])
+                         for name, key in keys.items()
+                         if key in self._instances)
+        missing = [name for name in names if name not in found]
+        if missing:
+            discovered = running_instances._discover_many(missing,
+                                                          address_attributes)
+            with self._lock:
+                for name, instances in discovered.items():
+                    self._instances[keys[name]] = instances
+                    self._watched[keys[name]] = (
+                        running_instances, name, tuple(address_attributes))
+            found.update(discovered)
+        return found
+
+    def refresh(self):
+        """Rediscover every tag asked about so far, with one ec2 request for
+        each combination of address attributes, vpc, regions and filters"""
+        groups = {}
+        with self._lock:
+            for running_instances, name, attributes in self._watched.values():
+                groups.setdefault((running_instances, attributes),
+                                  []).append(name)
+        for (running_instances, attributes), names in groups.items():
+            try:
+                discovered = running_instances._discover_many(
+                    names, list(attributes))
+            except Exception:
+                logger.exception('Could not refresh %s', ', '.join(names))
+                continue
+            with self._lock:
+                for name, instances in discovered.items():
+                    key = running_instances._cache_key(name, attributes)
+                    self._instances[key] = instances
+
+    def _refresh_forever(self):
+        while not self._stopped.wait(self.interval):
+            self.refresh()
+
+    def _in_use(self):
+        """Whether something answers on the socket at path"""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(1)
+            probe.connect(self.path)
+        except socket.error:
+            return False
+        else:
+            return True
+        finally:
+            probe.close()
+
+    def _listen(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        if self._in_use():
+            raise RuntimeError('A caiman sidecar is already listening on '
+                               '{}'.format(self.path))
+        try:
+            if stat.S_ISSOCK(os.stat(self.path).st_mode):
+                # left behind by a sidecar that did not shut down cleanly
+                os.unlink(self.path)
+        except OSError:
+            pass
+        server = _Server(self.path, _Handler)
+        server.sidecar = self
+        return server
+
+    def start(self):
+        """Listen and refresh in background threads"""
+        self._server = self._listen()
+        self._threads = [threading.Thread(target=self._server.serve_forever,
+                                          args=(0.1, )),
+                         threading.Thread(target=self._refresh_forever)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def serve_forever(self):
+        """Listen and refresh until interrupted"""
+        self.start()
+        try:
+            while not self._stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,7 +1,41 @@
 import os
+import sys
+import json
+import shutil
+import asyncio
+import tempfile
+from io import StringIO
+import socket
+import logging
+import threading
+import subprocess
 import caiman
+import caiman.aio
+import caiman.cli
+import caiman.sidecar
 import fudge
 import pytest
+from fudge.inspector import arg
+
+from benchmarks.fake_ec2 import FakeEc2Server, make_fleet
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(predicate, timeout=1.0):
+    event = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        event.wait(0.01)
+    return predicate()
 
 
 class TestRunningInstance(object):
@@ -141,8 +175,849 @@ class TestRunningInstance(object):
         assert list(addresses) == ['yes', 'yes']
 
 
+    @fudge.patch('caiman.get_running_instances')
+    def test_passes_vpc_id_through(self, get_running_instances):
+
+        (get_running_instances
+         .expects_call()
+         .with_args('some_name', vpc_id='vpc-1234')
+         .returns(iter(range(2))))
+
+        running_instances = caiman.RunningInstances(vpc_id='vpc-1234')
+        assert len(list(running_instances('some_name'))) == 2
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_cache_avoids_repeat_discovery(self, get_running_instances):
+
+        (get_running_instances
+         .expects_call()
+         .times_called(1)
+         .with_args('some_name')
+         .returns(iter(range(3))))
+
+        cache = caiman.DiscoveryCache(ttl=60)
+        running_instances = caiman.RunningInstances(cache=cache)
+        first = [i.instance for i in running_instances('some_name')]
+        second = [i.instance for i in running_instances('some_name')]
+        assert first == second == [0, 1, 2]
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_cache_is_keyed_by_address_order(self, get_running_instances):
+
+        attrs = dict(publicIp='public', private_ip_address='private')
+        response = [type('a', (object, ), attrs)]
+
+        (get_running_instances
+         .expects_call()
+         .returns(iter(response))
+         .next_call()
+         .returns(iter(response)))
+
+        cache = caiman.DiscoveryCache(ttl=60)
+        running_instances = caiman.RunningInstances(cache=cache)
+        assert running_instances.first_address('tag') == 'public'
+        with running_instances.address_lookup_order('private_ip_address'):
+            assert running_instances.first_address('tag') == 'private'
+        assert running_instances.first_address('tag') == 'public'
+
+
+class TestMultipleRegions(object):
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_yields_regions_as_they_answer(self, get_running_instances):
+        delays = {'eu-west-1': 0.2, 'us-east-1': 0.0, 'ap-south-1': 0.1}
+
+        def fake_discovery(name, vpc_id, region, page_size):
+            threading.Event().wait(delays[region])
+            return iter([region + '-instance'])
+        get_running_instances.expects_call().calls(fake_discovery)
+
+        running_instances = caiman.RunningInstances(regions=sorted(delays))
+        result = list(running_instances('some_name'))
+        assert [i.region_name for i in result] == ['us-east-1', 'ap-south-1',
+                                                   'eu-west-1']
+        assert [i.instance for i in result] == ['us-east-1-instance',
+                                                'ap-south-1-instance',
+                                                'eu-west-1-instance']
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_queries_regions_concurrently(self, get_running_instances):
+        started = threading.Barrier(3, timeout=1)
+
+        def fake_discovery(name, vpc_id, region, page_size):
+            # only passes if all three regions are queried at once
+            started.wait()
+            return iter([region])
+        get_running_instances.expects_call().calls(fake_discovery)
+
+        running_instances = caiman.RunningInstances(
+            regions=['eu-west-1', 'us-east-1', 'ap-south-1'])
+        assert len(list(running_instances('some_name'))) == 3
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_default_region_is_recorded(self, get_running_instances):
+        get_running_instances.expects_call().returns(iter(range(1)))
+
+        instance, = caiman.RunningInstances().get_instances('some_name')
+        assert instance.region_name == caiman.REGION
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_resolve_many_merges_regions(self, by_tag):
+        def fake_by_tag(names, region):
+            return {'logger': [region + '-logger'], 'database': []}
+        by_tag.expects_call().calls(fake_by_tag)
+
+        running_instances = caiman.RunningInstances(
+            regions=['eu-west-1', 'us-east-1'])
+        result = running_instances.resolve_many(['logger', 'database'])
+        assert (sorted((i.region_name, i.instance) for i in result['logger']) ==
+                [('eu-west-1', 'eu-west-1-logger'),
+                 ('us-east-1', 'us-east-1-logger')])
+        assert result['database'] == []
+
+
+class TestResolveMany(object):
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_resolves_roles_with_one_request(self, by_tag):
+        os.environ['test_45'] = u'indexer'
+
+        logger = type('logger', (object, ), {'publicIp': '1.1'})
+        database = type('database', (object, ), {'publicIp': '2.2'})
+        (by_tag
+         .expects_call()
+         .times_called(1)
+         .with_args(arg.passes_test(
+             lambda names: sorted(names) == ['soma-indexer-database',
+                                             'soma-indexer-logger']))
+         .returns({'soma-indexer-logger': [logger],
+                   'soma-indexer-database': [database]}))
+
+        running_instances = caiman.RunningInstances('test_45')
+        result = running_instances.resolve_many(['logger', 'database'])
+        assert [i.address for i in result['logger']] == ['1.1']
+        assert [i.address for i in result['database']] == ['2.2']
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_only_requests_uncached_roles(self, by_tag):
+        cached = type('cached', (object, ), {'publicIp': '1.1'})
+        fresh = type('fresh', (object, ), {'publicIp': '2.2'})
+        (by_tag
+         .expects_call()
+         .with_args(['fresh'])
+         .returns({'fresh': [fresh]}))
+
+        cache = caiman.DiscoveryCache()
+        running_instances = caiman.RunningInstances(cache=cache)
+        cache.set(running_instances._cache_key('cached', []),
+                  [caiman.Ec2Instance(cached)])
+        result = running_instances.resolve_many(['cached', 'fresh'])
+        assert [i.address for i in result['cached']] == ['1.1']
+        assert [i.address for i in result['fresh']] == ['2.2']
+        assert running_instances.first_address('fresh') == '2.2'
+
+
+class TestAsyncRunningInstances(object):
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_get_instances_is_awaitable(self, get_running_instances):
+
+        (get_running_instances
+         .expects_call()
+         .with_args('some_name')
+         .returns(iter(range(3))))
+
+        running_instances = caiman.aio.AsyncRunningInstances()
+        result = asyncio.run(running_instances.get_instances('some_name'))
+        assert [res.instance for res in result] == [0, 1, 2]
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_resolves_roles_and_address_order(self, get_running_instances):
+        os.environ['test_45'] = u'indexer'
+
+        attrs = dict(publicIp='no', private_ip='yes')
+        response = [type('a', (object, ), attrs)]
+
+        (get_running_instances
+         .expects_call()
+         .with_args('soma-indexer-purpose')
+         .returns(iter(response)))
+
+        running_instances = (caiman.aio
+                             .AsyncRunningInstances
+                             .address_order('test_45', ['private_ip']))
+        address = asyncio.run(running_instances.first_address('purpose'))
+        assert address == 'yes'
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_lookups_can_be_gathered(self, get_running_instances):
+        logger = type('logger', (object, ), {'publicIp': '1.1'})
+        database = type('database', (object, ), {'publicIp': '2.2'})
+
+        def fake_discovery(name):
+            return iter({'logger': [logger], 'database': [database]}[name])
+        get_running_instances.expects_call().calls(fake_discovery)
+
+        running_instances = caiman.aio.AsyncRunningInstances(max_concurrency=1)
+
+        async def lookup():
+            return await asyncio.gather(
+                running_instances.first_address('logger'),
+                running_instances.first_address('database'),
+                running_instances.addresses('database'))
+
+        assert asyncio.run(lookup()) == ['1.1', '2.2', ['2.2']]
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_first_address_default(self, get_running_instances):
+        get_running_instances.expects_call().returns(iter([]))
+
+        running_instances = caiman.aio.AsyncRunningInstances()
+        address = asyncio.run(running_instances.first_address('gone', 'none'))
+        assert address == 'none'
+
+
+class Host(object):
+
+    def __init__(self, id, publicIp=None):
+        self.id = id
+        self.publicIp = publicIp
+
+    def __repr__(self):
+        return self.id
+
+
+class FixedProbe(caiman.LatencyProbe):
+
+    def __init__(self, latencies, **kwargs):
+        super(FixedProbe, self).__init__(port=0, **kwargs)
+        self.fixed = latencies
+        self.probed = []
+
+    def measure(self, address):
+        self.probed.append(address)
+        return self.fixed.get(address)
+
+
+class ZonedHost(object):
+
+    def __init__(self, id, placement):
+        self.id = id
+        self.placement = placement
+        self.publicIp = 'public-' + id
+        self.private_ip_address = 'private-' + id
+
+
+class TestZoneAffinity(object):
+
+    def setup_method(self, method):
+        self.hosts = [ZonedHost('a', 'eu-west-1a'), ZonedHost('b', 'eu-west-1b'),
+                      ZonedHost('c', 'eu-west-1b')]
+        os.environ.pop('CAIMAN_AVAILABILITY_ZONE', None)
+        del caiman._local_zone[:]
+        caiman._local_zone_retry[0] = 0
+
+    def teardown_method(self, method):
+        os.environ.pop('CAIMAN_AVAILABILITY_ZONE', None)
+        del caiman._local_zone[:]
+        caiman._local_zone_retry[0] = 0
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_same_zone_private_addresses_come_first(self, get_running_instances):
+        get_running_instances.expects_call().calls(lambda name: iter(self.hosts))
+
+        running_instances = caiman.RunningInstances(zone_affinity='eu-west-1b')
+        assert list(running_instances.addresses('db')) == [
+            'private-b', 'private-c', 'public-a']
+        assert running_instances.first_address('db') == 'private-b'
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_records_and_resolve_many(self, get_running_instances_by_tag):
+        (get_running_instances_by_tag
+         .expects_call()
+         .returns({'db': self.hosts}))
+
+        running_instances = caiman.RunningInstances(
+            records=True, cache=caiman.DiscoveryCache(),
+            zone_affinity='eu-west-1a')
+        resolved = running_instances.resolve_many(['db'])
+        assert [i.address for i in resolved['db']] == [
+            'private-a', 'public-b', 'public-c']
+        assert list(running_instances.addresses('db')) == [
+            'private-a', 'public-b', 'public-c']
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_custom_lookup_order_prefers_private_addresses(
+            self, get_running_instances):
+        get_running_instances.expects_call().calls(lambda name: iter(self.hosts))
+
+        for records in (False, True):
+            running_instances = caiman.RunningInstances.address_order(
+                address_attributes=['publicIp'], records=records,
+                zone_affinity='eu-west-1b')
+            assert list(running_instances.addresses('db')) == [
+                'private-b', 'private-c', 'public-a']
+
+    @fudge.patch('caiman.get_running_instances', 'caiman._read_metadata')
+    def test_without_zone_order_is_kept(self, get_running_instances,
+                                        read_metadata):
+        get_running_instances.expects_call().calls(lambda name: iter(self.hosts))
+        read_metadata.expects_call().returns(None)
+
+        running_instances = caiman.RunningInstances(zone_affinity=True)
+        assert list(running_instances.addresses('db')) == [
+            'public-a', 'public-b', 'public-c']
+
+    @fudge.patch('caiman._read_metadata')
+    def test_local_zone_is_read_once_from_metadata(self, read_metadata):
+        (read_metadata
+         .expects_call()
+         .times_called(1)
+         .with_args('meta-data/placement/availability-zone', 0.5)
+         .returns('eu-west-1c'))
+        assert caiman.local_zone() == 'eu-west-1c'
+        assert caiman.local_zone() == 'eu-west-1c'
+
+    @fudge.patch('caiman._read_metadata')
+    def test_failed_metadata_reads_are_retried(self, read_metadata):
+        (read_metadata
+         .expects_call()
+         .returns(None)
+         .next_call()
+         .returns('eu-west-1c'))
+        assert caiman.local_zone(retry_interval=60) is None
+        # not retried until retry_interval has passed
+        assert caiman.local_zone(retry_interval=60) is None
+        caiman._local_zone_retry[0] = 0
+        assert caiman.local_zone() == 'eu-west-1c'
+        assert caiman.local_zone() == 'eu-west-1c'
+
+    def test_local_zone_can_be_overridden(self):
+        os.environ['CAIMAN_AVAILABILITY_ZONE'] = 'eu-west-1b'
+        assert caiman.local_zone() == 'eu-west-1b'
+
+
+class TestWarm(object):
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_fills_cache_for_every_role(self, get_running_instances):
+        hosts = {'logger': [Host('i-l', '1.1')], 'database': [Host('i-d', '2.2')]}
+        (get_running_instances
+         .expects_call()
+         .times_called(2)
+         .calls(lambda name: iter(hosts[name])))
+
+        warmed = caiman.warm(['logger', 'database'], timeout=1)
+        assert warmed.unresolved == []
+        assert sorted(warmed.resolved) == ['database', 'logger']
+        assert warmed.running_instances.first_address('logger') == '1.1'
+        assert warmed.running_instances.first_address('database') == '2.2'
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_reports_roles_not_resolved_in_time(self, get_running_instances):
+        release = threading.Event()
+
+        def discover(name):
+            if name == 'slow':
+                release.wait(1)
+            if name == 'broken':
+                raise RuntimeError('boom')
+            return iter([Host('i-' + name, name)])
+        get_running_instances.expects_call().calls(discover)
+
+        running_instances = caiman.RunningInstances(cache=caiman.DiscoveryCache())
+        try:
+            warmed = caiman.warm(['fast', 'slow', 'broken'], timeout=0.1,
+                                 running_instances=running_instances)
+        finally:
+            release.set()
+        assert warmed.running_instances is running_instances
+        assert list(warmed.resolved) == ['fast']
+        assert sorted(warmed.unresolved) == ['broken', 'slow']
+        assert wait_for(lambda: ('slow', None, None, ()) in running_instances.cache)
+
+
+class TestLatencyProbe(object):
+
+    def test_measures_listening_ports(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            probe = caiman.LatencyProbe(listener.getsockname()[1])
+            assert probe.measure('127.0.0.1') is not None
+        finally:
+            listener.close()
+        assert probe.measure('127.0.0.1') is None
+
+    def test_picks_lowest_latency_responsive_address(self):
+        probe = FixedProbe({'slow': 0.2, 'fast': 0.01, 'down': None})
+        assert probe.fastest(['down', 'slow', 'fast']) == 'fast'
+
+    def test_falls_back_to_first_address(self):
+        probe = FixedProbe({})
+        assert probe.fastest(['first', 'second']) == 'first'
+        assert probe.fastest([]) is None
+
+    def test_results_are_reused_within_interval(self):
+        clock = FakeClock()
+        probe = FixedProbe({'a': 0.1, 'b': 0.2}, interval=30, clock=clock)
+        probe.fastest(['a', 'b'])
+        probe.fastest(['a', 'b'])
+        assert sorted(probe.probed) == ['a', 'b']
+        clock.now += 31
+        probe.fastest(['a'])
+        assert sorted(probe.probed) == ['a', 'a', 'b']
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_first_address_uses_probe(self, get_running_instances):
+        slow = type('slow', (object, ), {'publicIp': 'slow'})
+        fast = type('fast', (object, ), {'publicIp': 'fast'})
+        get_running_instances.expects_call().returns(iter([slow, fast]))
+
+        probe = FixedProbe({'slow': 0.2, 'fast': 0.01})
+        running_instances = caiman.RunningInstances(probe=probe)
+        assert running_instances.first_address('db') == 'fast'
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_first_address_default_with_probe(self, get_running_instances):
+        get_running_instances.expects_call().returns(iter([]))
+
+        running_instances = caiman.RunningInstances(probe=FixedProbe({}))
+        assert running_instances.first_address('db', 'none') == 'none'
+
+
+class TestWatcher(object):
+
+    def test_reports_added_and_removed_instances(self):
+        a, b, c = Host('i-a'), Host('i-b'), Host('i-c')
+        snapshots = iter([[a, b], [b, c], [b, c]])
+        changes = []
+
+        watcher = caiman.Watcher(lambda: next(snapshots))
+        watcher.add_callback(lambda added, removed:
+                             changes.append((added, removed)))
+        watcher.refresh()
+        watcher.refresh()
+        watcher.refresh()
+        assert changes == [(set([a, b]), set()), (set([c]), set([a]))]
+
+    def test_late_callbacks_get_current_instances(self):
+        a = Host('i-a')
+        watcher = caiman.Watcher(lambda: [a])
+        watcher.refresh()
+        changes = []
+        watcher.add_callback(lambda added, removed:
+                             changes.append((added, removed)))
+        assert changes == [(set([a]), set())]
+
+    def test_keeps_snapshot_when_discovery_fails(self):
+        a = Host('i-a')
+        results = iter([[a]])
+        watcher = caiman.Watcher(lambda: next(results))
+        watcher.refresh()
+        watcher.refresh()  # raises StopIteration inside discover
+        assert watcher.instances == {'i-a': a}
+
+    def test_callback_errors_do_not_stop_other_callbacks(self):
+        changes = []
+
+        def broken(added, removed):
+            raise RuntimeError('boom')
+
+        watcher = caiman.Watcher(lambda: [Host('i-a')])
+        watcher.add_callback(broken)
+        watcher.add_callback(lambda added, removed: changes.append(added))
+        watcher.refresh()
+        assert len(changes) == 1
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_running_instances_watch(self, get_running_instances):
+        (get_running_instances
+         .expects_call()
+         .with_args('indexer')
+         .returns(iter([Host('i-a', '1.1')]))
+         .next_call()
+         .with_args('indexer')
+         .returns(iter([Host('i-b', '2.2')])))
+
+        changes = []
+        changed = threading.Event()
+
+        def on_change(added, removed):
+            changes.append((sorted(i.address for i in added),
+                            sorted(i.address for i in removed)))
+            if len(changes) == 2:
+                changed.set()
+
+        running_instances = caiman.RunningInstances()
+        watcher = running_instances.watch('indexer', interval=0.01,
+                                          on_change=on_change)
+        try:
+            assert changed.wait(1)
+        finally:
+            running_instances.unwatch('indexer')
+        assert not watcher.running
+        assert changes[:2] == [(['1.1'], []), (['2.2'], ['1.1'])]
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_one_watcher_per_role(self, get_running_instances):
+        get_running_instances.expects_call().returns(iter([]))
+
+        running_instances = caiman.RunningInstances()
+        try:
+            first = running_instances.watch('indexer', interval=60)
+            second = running_instances.watch('indexer', interval=60)
+            assert first is second
+        finally:
+            running_instances.unwatch('indexer')
+
+
+class TestInstanceRecord(object):
+
+    def boto_instance(self):
+        Instance = type('Instance', (object, ), {})
+        instance = Instance()
+        instance.id = 'i-1234'
+        instance.tags = {'soma-demo-logger': ''}
+        instance.placement = 'eu-west-1a'
+        instance.state = 'running'
+        instance.public_dns_name = 'ec2-1-2-3-4.amazonaws.com'
+        instance.private_ip_address = '10.0.0.1'
+        instance.block_device_mapping = {'/dev/sda1': object()}
+        return instance
+
+    def test_copies_used_fields(self):
+        record = caiman.InstanceRecord.from_instance(self.boto_instance(),
+                                                     region_name='eu-west-1')
+        assert record.id == 'i-1234'
+        assert record.tags == {'soma-demo-logger': ''}
+        assert record.placement == 'eu-west-1a'
+        assert record.state == 'running'
+        assert record.region_name == 'eu-west-1'
+        assert record.address == 'ec2-1-2-3-4.amazonaws.com'
+        assert record.private_ip_address == '10.0.0.1'
+        with pytest.raises(AttributeError):
+            record.block_device_mapping
+
+    def test_follows_address_attributes(self):
+        record = caiman.InstanceRecord.from_instance(
+            self.boto_instance(), ['private_ip_address'])
+        assert record.address == '10.0.0.1'
+        assert repr(record) == '10.0.0.1'
+
+    def test_has_no_instance_dict(self):
+        record = caiman.InstanceRecord('i-1234')
+        assert not hasattr(record, '__dict__')
+        with pytest.raises(AttributeError):
+            record.anything_else = True
+
+    def test_round_trips_through_dict(self):
+        record = caiman.InstanceRecord.from_instance(self.boto_instance())
+        copy = caiman.InstanceRecord(**record.to_dict())
+        assert copy.to_dict() == record.to_dict()
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_running_instances_can_return_records(self, get_running_instances):
+        (get_running_instances
+         .expects_call()
+         .returns(iter([self.boto_instance()])))
+
+        running_instances = caiman.RunningInstances(records=True)
+        record, = running_instances.get_instances('logger')
+        assert isinstance(record, caiman.InstanceRecord)
+        assert record.address == 'ec2-1-2-3-4.amazonaws.com'
+        assert record.region_name == caiman.REGION
+
+
+class TestDiscoverySnapshot(object):
+
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.json')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.directory)
+
+    def instances(self):
+        Instance = type('Instance', (object, ), {})
+        instance = Instance()
+        instance.id = 'i-1234'
+        instance.tags = {'logger': ''}
+        instance.private_ip_address = '10.0.0.1'
+        return [caiman.Ec2Instance(instance, region_name='eu-west-1')]
+
+    def test_round_trips_instances(self):
+        caiman.DiscoverySnapshot(self.path).write(('logger', ), self.instances())
+
+        instance, = caiman.DiscoverySnapshot(self.path).get(('logger', ))
+        assert instance.address == '10.0.0.1'
+        assert instance.id == 'i-1234'
+        assert instance.tags == {'logger': ''}
+        assert instance.region_name == 'eu-west-1'
+        leftovers = [name for name in os.listdir(self.directory)
+                     if name.startswith('.caiman-')]
+        assert leftovers == []
+
+    def test_expired_entries_are_not_fresh(self):
+        clock = FakeClock()
+        snapshot = caiman.DiscoverySnapshot(self.path, max_age=10, clock=clock)
+        snapshot.write(('logger', ), self.instances())
+        clock.now += 11
+        assert snapshot.get(('logger', )) is None
+        assert len(snapshot.get(('logger', ), max_age=float('inf'))) == 1
+
+    def test_missing_or_corrupt_file_is_empty(self):
+        assert caiman.DiscoverySnapshot(self.path).get(('logger', )) is None
+        with open(self.path, 'w') as snapshot:
+            snapshot.write('{not json')
+        assert caiman.DiscoverySnapshot(self.path).get(('logger', )) is None
+
+    def test_updates_keep_other_entries(self):
+        caiman.DiscoverySnapshot(self.path).write(('logger', ), self.instances())
+        caiman.DiscoverySnapshot(self.path).write(('database', ), [])
+        snapshot = caiman.DiscoverySnapshot(self.path)
+        assert len(snapshot.get(('logger', ))) == 1
+        assert snapshot.get(('database', )) == []
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_other_processes_skip_discovery(self, get_running_instances):
+        public = type('public', (object, ), {'publicIp': '44.55', 'id': 'i-1'})
+        (get_running_instances
+         .expects_call()
+         .times_called(1)
+         .returns(iter([public])))
+
+        for _ in range(3):
+            running_instances = caiman.RunningInstances(
+                snapshot=caiman.DiscoverySnapshot(self.path))
+            assert running_instances.first_address('logger') == '44.55'
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_returns_records_whether_discovered_or_read(
+            self, get_running_instances):
+        public = type('public', (object, ), {'publicIp': '44.55', 'id': 'i-1'})
+        get_running_instances.expects_call().returns(iter([public]))
+
+        running_instances = caiman.RunningInstances(
+            snapshot=caiman.DiscoverySnapshot(self.path))
+        for _ in range(2):
+            instance, = running_instances.get_instances('logger')
+            assert isinstance(instance, caiman.InstanceRecord)
+            assert instance.address == '44.55'
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_falls_back_to_stale_entries(self, get_running_instances):
+        def unavailable(name):
+            raise IOError('ec2 is down')
+        get_running_instances.expects_call().calls(unavailable)
+
+        clock = FakeClock()
+        snapshot = caiman.DiscoverySnapshot(self.path, max_age=10, clock=clock)
+        running_instances = caiman.RunningInstances(snapshot=snapshot)
+        snapshot.write(running_instances._cache_key('logger', []),
+                       self.instances())
+        clock.now += 11
+
+        assert running_instances.first_address('logger') == '10.0.0.1'
+        with pytest.raises(IOError):
+            running_instances.first_address('database')
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_resolve_many_uses_snapshot(self, by_tag):
+        database = type('database', (object, ), {'publicIp': '2.2'})
+        (by_tag
+         .expects_call()
+         .with_args(['database'])
+         .returns({'database': [database]}))
+
+        running_instances = caiman.RunningInstances(
+            snapshot=caiman.DiscoverySnapshot(self.path))
+        running_instances.snapshot.write(
+            running_instances._cache_key('logger', []), self.instances())
+
+        result = running_instances.resolve_many(['logger', 'database'])
+        assert [i.address for i in result['logger']] == ['10.0.0.1']
+        assert [i.address for i in result['database']] == ['2.2']
+        assert running_instances.snapshot.get(
+            running_instances._cache_key('database', [])) is not None
+
+
+class WatchedInstances(object):
+    """RunningInstances stand in whose watcher is refreshed by hand"""
+
+    def __init__(self, *snapshots):
+        snapshots = iter(snapshots)
+        self.watcher = caiman.Watcher(
+            lambda: [caiman.Ec2Instance(host) for host in next(snapshots)])
+
+    def watch(self, description, interval, on_change):
+        self.watcher.add_callback(on_change)
+        return self.watcher
+
+
+class TestBalancer(object):
+
+    def test_round_robin(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a'), Host('i-b', 'b'), Host('i-c', 'c')])
+        balancer = caiman.Balancer(running_instances, 'db')
+        assert balancer.pick() is None
+        running_instances.watcher.refresh()
+        picks = [balancer.pick() for _ in range(4)]
+        assert sorted(picks[:3]) == ['a', 'b', 'c']
+        assert picks[3] == picks[0]
+
+    def test_follows_membership_changes(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a'), Host('i-b', 'b')], [Host('i-b', 'b')])
+        balancer = caiman.Balancer(running_instances, 'db', 'random')
+        running_instances.watcher.refresh()
+        assert balancer.wait(0)
+        assert sorted(balancer.addresses) == ['a', 'b']
+        running_instances.watcher.refresh()
+        assert set(balancer.pick() for _ in range(10)) == set(['b'])
+
+    def test_power_of_two_prefers_less_busy(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a'), Host('i-b', 'b')])
+        balancer = caiman.Balancer(running_instances, 'db', 'power_of_two')
+        running_instances.watcher.refresh()
+        balancer.started('a')
+        assert set(balancer.pick() for _ in range(10)) == set(['b'])
+        balancer.finished('a')
+        balancer.started('b')
+        assert set(balancer.pick() for _ in range(10)) == set(['a'])
+
+    def test_request_tracks_in_flight(self):
+        running_instances = WatchedInstances([Host('i-a', 'a')])
+        balancer = caiman.Balancer(running_instances, 'db', 'power_of_two')
+        running_instances.watcher.refresh()
+        with balancer.request() as address:
+            assert address == 'a'
+            assert balancer._inflight['a'] == 1
+        assert balancer._inflight['a'] == 0
+
+    def test_rejects_unknown_strategy(self):
+        with pytest.raises(ValueError):
+            caiman.Balancer(WatchedInstances(), 'db', 'fastest')
+
+    def test_stop_detaches_from_watcher(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a')], [Host('i-b', 'b')])
+        balancer = caiman.Balancer(running_instances, 'db')
+        running_instances.watcher.refresh()
+        balancer.stop()
+        running_instances.watcher.refresh()
+        assert balancer.addresses == ['a']
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_with_running_instances(self, get_running_instances):
+        (get_running_instances
+         .expects_call()
+         .returns(iter([Host('i-a', 'a'), Host('i-b', 'b')])))
+
+        running_instances = caiman.RunningInstances()
+        balancer = caiman.Balancer(running_instances, 'db', interval=60)
+        try:
+            assert balancer.wait(1)
+            assert sorted([balancer.pick(), balancer.pick()]) == ['a', 'b']
+        finally:
+            running_instances.unwatch('db')
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_stop_ends_discovery(self, get_running_instances):
+        calls = []
+
+        def discover(name):
+            calls.append(name)
+            return iter([Host('i-a', 'a')])
+        get_running_instances.expects_call().calls(discover)
+
+        running_instances = caiman.RunningInstances()
+        balancer = caiman.Balancer(running_instances, 'db', interval=0.01)
+        assert wait_for(lambda: len(calls) > 1)
+        balancer.stop()
+        assert not balancer.watcher.running
+        balancer.watcher._thread.join(1)
+        made = len(calls)
+        threading.Event().wait(0.05)
+        assert len(calls) == made
+
+        # watching again starts a new watcher
+        other = caiman.Balancer(running_instances, 'db', interval=60)
+        try:
+            assert other.watcher is not balancer.watcher
+            assert other.wait(1)
+        finally:
+            running_instances.unwatch('db')
+
+
+class TestDiscoveryCache(object):
+
+    def test_loads_on_miss(self):
+        cache = caiman.DiscoveryCache()
+        assert cache.get('key', lambda: [1]) == [1]
+        assert 'key' in cache
+
+    def test_serves_fresh_entries_without_loading(self):
+        cache = caiman.DiscoveryCache(ttl=10, clock=FakeClock())
+        cache.set('key', [1])
+        assert cache.get('key', lambda: pytest.fail('should not load')) == [1]
+
+    def test_evicts_least_recently_used(self):
+        cache = caiman.DiscoveryCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a', lambda: None)
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert len(cache) == 2
+
+    def test_serves_stale_entry_while_refreshing(self):
+        clock = FakeClock()
+        cache = caiman.DiscoveryCache(ttl=10, clock=clock)
+        cache.set('key', 'stale')
+        clock.now += 11
+
+        refreshed = threading.Event()
+
+        def load():
+            refreshed.set()
+            return 'fresh'
+
+        assert cache.get('key', load) == 'stale'
+        assert refreshed.wait(1)
+        assert wait_for(lambda: not cache._refreshing)
+        assert cache.get('key', load) == 'fresh'
+
+    def test_only_one_refresh_per_key(self):
+        clock = FakeClock()
+        cache = caiman.DiscoveryCache(ttl=10, clock=clock)
+        cache.set('key', 'stale')
+        clock.now += 11
+
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            release.wait(1)
+            return 'fresh'
+
+        cache.get('key', load)
+        cache.get('key', load)
+        release.set()
+        assert wait_for(lambda: not cache._refreshing)
+        assert calls == [1]
+
+
 class TestGetRunningInstances(object):
 
+    def setup_method(self, method):
+        caiman.connection_pool.clear()
+
     @fudge.patch('caiman.connect_to_region')
     def test_with_reservations(self, connect_to_region):
 
@@ -167,6 +1042,690 @@ class TestGetRunningInstances(object):
         assert instances == []
 
 
+class Page(list):
+    """Stand in for a boto ResultSet"""
+
+    def __init__(self, instances, next_token=None):
+        reservation = fudge.Fake('reservation').has_attr(instances=instances)
+        super(Page, self).__init__([reservation])
+        self.next_token = next_token
+
+
+class TestPagedRunningInstances(object):
+
+    def setup_method(self, method):
+        caiman.connection_pool.clear()
+
+    def fake_connection(self, pages, requests):
+        def get_list(action, params, markers, verb):
+            requests.append(dict(params))
+            return pages[params.get('NextToken')]
+
+        return (fudge.Fake('connection')
+                .provides('build_filter_params')
+                .provides('get_list').calls(get_list))
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_follows_next_token(self, connect_to_region):
+        requests = []
+        pages = {None: Page([1, 2], 'token-2'), 'token-2': Page([3])}
+        (connect_to_region
+         .expects_call()
+         .returns(self.fake_connection(pages, requests)))
+
+        instances = caiman.get_running_instances('n/a', page_size=2)
+        assert list(instances) == [1, 2, 3]
+        assert requests == [{'MaxResults': 2},
+                            {'MaxResults': 2, 'NextToken': 'token-2'}]
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_first_address_only_fetches_first_page(self, connect_to_region):
+        requests = []
+        public = type('public', (object, ), {'publicIp': '44.55'})
+        pages = {None: Page([public], 'token-2'), 'token-2': Page([public])}
+        (connect_to_region
+         .expects_call()
+         .returns(self.fake_connection(pages, requests)))
+
+        running_instances = caiman.RunningInstances(page_size=5)
+        assert running_instances.first_address('n/a') == '44.55'
+        assert len(requests) == 1
+
+
+class TestGetRunningInstancesByTag(object):
+
+    def setup_method(self, method):
+        caiman.connection_pool.clear()
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_groups_instances_by_tag(self, connect_to_region):
+        Instance = type('Instance', (object, ), {})
+        logger, database, both = Instance(), Instance(), Instance()
+        logger.tags = {'logger': ''}
+        database.tags = {'database': ''}
+        both.tags = {'logger': '', 'database': ''}
+
+        reservations = [
+            fudge.Fake('reservation').has_attr(instances=[logger, both]),
+            fudge.Fake('reservation').has_attr(instances=[database])]
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances')
+                      .with_args(filters={'tag-key': ['logger', 'database',
+                                                      'indexer'],
+                                          'instance-state-name': 'running'})
+                      .returns(reservations))
+        connect_to_region.expects_call().returns(connection)
+
+        grouped = caiman.get_running_instances_by_tag(['logger', 'database',
+                                                       'indexer'])
+        assert grouped == {'logger': [logger, both],
+                           'database': [both, database],
+                           'indexer': []}
+
+
+class TestConnectionPool(object):
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_reuses_connections(self, connect_to_region):
+        connection = fudge.Fake('connection')
+        (connect_to_region
+         .expects_call()
+         .times_called(1)
+         .with_args('eu-west-1')
+         .returns(connection))
+
+        pool = caiman.ConnectionPool()
+        with pool.connection('eu-west-1') as first:
+            pass
+        with pool.connection('eu-west-1') as second:
+            pass
+        assert first is second is connection
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_concurrent_checkouts_get_separate_connections(self, connect_to_region):
+        (connect_to_region
+         .expects_call()
+         .returns(fudge.Fake('one'))
+         .next_call()
+         .returns(fudge.Fake('two')))
+
+        pool = caiman.ConnectionPool()
+        with pool.connection('eu-west-1') as first:
+            with pool.connection('eu-west-1') as second:
+                assert first is not second
+        assert len(pool) == 2
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_failed_connections_are_discarded(self, connect_to_region):
+        connect_to_region.expects_call().returns(fudge.Fake('connection'))
+
+        pool = caiman.ConnectionPool()
+        with pytest.raises(RuntimeError):
+            with pool.connection('eu-west-1'):
+                raise RuntimeError('boom')
+        assert len(pool) == 0
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_is_emptied_after_fork(self, connect_to_region):
+        connect_to_region.expects_call().returns(fudge.Fake('connection'))
+
+        pool = caiman.ConnectionPool()
+        with pool.connection('eu-west-1'):
+            pass
+        pool._pid = -1  # pretend we are now in a forked child
+        with pool.connection('eu-west-1'):
+            assert len(pool) == 0
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_can_be_resized_and_cleared(self, connect_to_region):
+        connect_to_region.expects_call().returns(fudge.Fake('connection'))
+
+        pool = caiman.ConnectionPool(maxsize=2)
+        with pool.connection('eu-west-1'):
+            with pool.connection('eu-west-1'):
+                pass
+        assert len(pool) == 2
+        pool.resize(1)
+        assert len(pool) == 1
+        pool.clear()
+        assert len(pool) == 0
+
+
+class ThrottledError(Exception):
+    error_code = 'RequestLimitExceeded'
+
+
+class TestThrottling(object):
+
+    def setup_method(self, method):
+        caiman.connection_pool.clear()
+        self.backoff = caiman.backoff
+        caiman.backoff = caiman.Backoff(attempts=2, base=0)
+
+    def teardown_method(self, method):
+        caiman.backoff = self.backoff
+
+    def test_token_bucket_allows_bursts_then_waits(self):
+        clock = FakeClock(0)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+
+        bucket = caiman.TokenBucket(rate=2, capacity=2, clock=clock, sleep=sleep)
+        for _ in range(3):
+            bucket.acquire()
+        assert sleeps == [0.5]
+
+    def test_token_bucket_below_one_request_per_second(self):
+        clock = FakeClock(0)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+
+        bucket = caiman.TokenBucket(rate=0.5, clock=clock, sleep=sleep)
+        assert bucket.capacity == 1
+        bucket.acquire()
+        bucket.acquire()
+        assert sleeps == [2]
+
+    def test_backoff_delay_is_jittered_and_capped(self):
+        backoff = caiman.Backoff(base=1, cap=4)
+        for attempt in range(10):
+            assert 0 <= backoff.delay(attempt) <= min(4, 2 ** attempt)
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_throttled_requests_are_retried(self, connect_to_region):
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances')
+                      .raises(ThrottledError())
+                      .next_call()
+                      .returns([fudge.Fake('reservation').has_attr(instances=[1])]))
+        connect_to_region.expects_call().returns(connection)
+        assert list(caiman.get_running_instances('n/a')) == [1]
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_gives_up_after_attempts(self, connect_to_region):
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances')
+                      .raises(ThrottledError()))
+        connect_to_region.expects_call().returns(connection)
+        with pytest.raises(ThrottledError):
+            list(caiman.get_running_instances('n/a'))
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_other_errors_are_not_retried(self, connect_to_region):
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances')
+                      .times_called(1)
+                      .raises(RuntimeError('boom')))
+        connect_to_region.expects_call().returns(connection)
+        with pytest.raises(RuntimeError):
+            list(caiman.get_running_instances('n/a'))
+
+
+class TestSingleFlight(object):
+
+    def setup_method(self, method):
+        self.metrics = caiman.Metrics()
+        self.previous = caiman.set_instrumentation(self.metrics)
+
+    def teardown_method(self, method):
+        caiman.set_instrumentation(self.previous)
+
+    def test_concurrent_calls_share_one_call(self):
+        single_flight = caiman.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(1)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(single_flight.do('key', slow)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        assert wait_for(lambda: self.metrics.counters['ec2.coalesced'] == 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert results == ['result'] * 5
+        assert calls == [1]
+        assert single_flight._calls == {}
+
+    def test_errors_are_shared_and_not_remembered(self):
+        single_flight = caiman.SingleFlight()
+
+        def fail():
+            raise RuntimeError('boom')
+
+        with pytest.raises(RuntimeError):
+            single_flight.do('key', fail)
+        assert single_flight.do('key', lambda: 'ok') == 'ok'
+
+    def test_identical_lookups_make_one_request(self):
+        fleet = make_fleet(10)
+        with FakeEc2Server(fleet, latency=0.2) as server:
+            with server.patch_caiman():
+                tag = caiman.get_name('web', 'demo')
+                threads = [threading.Thread(
+                    target=lambda: list(caiman.get_running_instances(tag)))
+                    for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        assert server.calls < 8
+
+
+class TestFakeEc2(object):
+    """discovery through boto against the benchmarks' fake ec2 endpoint"""
+
+    def setup_method(self, method):
+        os.environ['test_fake_ec2'] = u'demo'
+        self.server = FakeEc2Server(make_fleet(200)).start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+
+    def test_discovers_tagged_instances(self):
+        with self.server.patch_caiman():
+            running_instances = caiman.RunningInstances('test_fake_ec2')
+            instances = list(running_instances.get_instances('web'))
+        assert len(instances) == 50
+        assert all('soma-demo-web' in i.tags for i in instances)
+        assert self.server.calls == 1
+
+    def test_paged_first_address_makes_one_call(self):
+        with self.server.patch_caiman():
+            running_instances = caiman.RunningInstances('test_fake_ec2',
+                                                        page_size=5)
+            assert running_instances.first_address('web')
+            assert self.server.calls == 1
+            assert len(list(running_instances.get_instances('web'))) == 50
+            assert self.server.calls == 11
+
+    def test_resolve_many_makes_one_call(self):
+        with self.server.patch_caiman():
+            running_instances = caiman.RunningInstances('test_fake_ec2')
+            result = running_instances.resolve_many(['web', 'role1', 'role2'])
+        assert [len(result[role]) for role in ['web', 'role1', 'role2']] == [
+            50, 3, 3]
+        assert self.server.calls == 1
+
+
+def public_names(*numbers):
+    return ['ec2-54-0-0-{}.eu-west-1.compute.amazonaws.com'.format(number)
+            for number in numbers]
+
+
+class TestCli(object):
+
+    def setup_method(self, method):
+        os.environ['test_cli'] = u'demo'
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'cache', 'discovery.json')
+        self.server = FakeEc2Server(make_fleet(200)).start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def run(self, *argv):
+        out, err = StringIO(), StringIO()
+        with self.server.patch_caiman():
+            status = caiman.cli.main(
+                ['addresses', '--env-var', 'test_cli', '--cache', self.cache]
+                + list(argv), out, err)
+        return status, out.getvalue(), err.getvalue()
+
+    def test_resolves_roles_with_one_request(self):
+        status, out, err = self.run('role0', 'role1', '--format', 'json')
+        assert status == 0
+        assert json.loads(out) == {'role0': public_names(1, 81, 161),
+                                   'role1': public_names(5, 85, 165)}
+        assert self.server.calls == 1
+
+    def test_prints_first_addresses_as_lines(self):
+        status, out, err = self.run('role0', 'role1', '--first')
+        assert (status, out) == (0, '\n'.join(public_names(1, 5)) + '\n')
+
+    def test_results_are_cached(self):
+        self.run('role0')
+        self.server.reset_calls()
+        status, out, err = self.run('role0')
+        assert out.split() == public_names(1, 81, 161)
+        assert self.server.calls == 0
+        self.run('role0', '--ttl', '0')
+        assert self.server.calls == 1
+
+    def test_missing_role_fails(self):
+        status, out, err = self.run('role0', 'nothing')
+        assert status == 1
+        assert 'no running instances for nothing' in err
+        assert out.split() == public_names(1, 81, 161)
+
+
+class TestSidecar(object):
+
+    def setup_method(self, method):
+        os.environ['test_sidecar'] = u'demo'
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sidecar.sock')
+        self.server = FakeEc2Server(make_fleet(200)).start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_processes_share_the_sidecars_requests(self):
+        with self.server.patch_caiman():
+            with caiman.sidecar.Sidecar(self.path):
+                first, second = [
+                    caiman.RunningInstances('test_sidecar', sidecar=self.path)
+                    for _ in range(2)]
+                assert first.first_address('role0') == public_names(1)[0]
+                assert list(second.addresses('role0')) == public_names(
+                    1, 81, 161)
+                assert second.resolve_many(['role0', 'role1'])['role1'][0] \
+                    .address == public_names(5)[0]
+        assert self.server.calls == 2
+
+    def test_passes_filters_to_sidecar(self):
+        with self.server.patch_caiman():
+            with caiman.sidecar.Sidecar(self.path) as sidecar:
+                running_instances = caiman.RunningInstances(
+                    'test_sidecar', sidecar=self.path,
+                    filters=caiman.Filters(availability_zone='eu-west-1a'))
+                instances = list(running_instances.get_instances('web'))
+        assert list(sidecar._watched) == [
+            running_instances._cache_key('soma-demo-web', [])]
+        assert len(instances) == 17
+        assert set(i.placement for i in instances) == set(['eu-west-1a'])
+
+    def test_refresh_rediscovers_tags_with_one_request(self):
+        with self.server.patch_caiman():
+            sidecar = caiman.sidecar.Sidecar(self.path)
+            sidecar.lookup(['soma-demo-role0'], [])
+            sidecar.lookup(['soma-demo-role1'], [])
+            self.server.reset_calls()
+            sidecar.refresh()
+            assert self.server.calls == 1
+            assert len(sidecar.lookup(['soma-demo-role1'], [])[
+                'soma-demo-role1']) == 3
+            assert self.server.calls == 1
+
+    def test_refuses_to_replace_a_running_sidecar(self):
+        with caiman.sidecar.Sidecar(self.path):
+            with pytest.raises(RuntimeError):
+                caiman.sidecar.Sidecar(self.path).start()
+            assert caiman.SidecarClient(self.path).lookup([], []) == {}
+
+    def test_replaces_socket_left_behind(self):
+        left_behind = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        left_behind.bind(self.path)
+        left_behind.close()
+        with caiman.sidecar.Sidecar(self.path):
+            assert caiman.SidecarClient(self.path).lookup([], []) == {}
+
+    def test_creates_socket_directory(self):
+        path = os.path.join(self.directory, 'run', 'sidecar.sock')
+        with caiman.sidecar.Sidecar(path):
+            assert caiman.SidecarClient(path).lookup([], []) == {}
+
+    def test_falls_back_to_ec2_without_sidecar(self):
+        with self.server.patch_caiman():
+            running_instances = caiman.RunningInstances('test_sidecar',
+                                                        sidecar=self.path)
+            instances = list(running_instances.get_instances('role0'))
+        assert instances[0].address == public_names(1)[0]
+        assert set(type(i) for i in instances) == set([caiman.InstanceRecord])
+        assert self.server.calls == 1
+
+    @fudge.patch('caiman.sidecar.Sidecar.lookup')
+    def test_sidecar_errors_fall_back_to_ec2(self, lookup):
+        lookup.expects_call().raises(RuntimeError('ec2 is down'))
+        with self.server.patch_caiman():
+            with caiman.sidecar.Sidecar(self.path):
+                client = caiman.SidecarClient(self.path)
+                with pytest.raises(RuntimeError):
+                    client.lookup(['soma-demo-role0'], [])
+                running_instances = caiman.RunningInstances(
+                    'test_sidecar', sidecar=client)
+                assert len(list(running_instances.get_instances('role0'))) == 3
+        assert self.server.calls == 1
+
+
+class TestInventoryIndex(object):
+
+    def setup_method(self, method):
+        os.environ['test_inventory'] = u'demo'
+        self.server = FakeEc2Server(make_fleet(200)).start()
+
+    def teardown_method(self, method):
+        self.server.stop()
+
+    def test_indexes_fleet_with_one_scan(self):
+        index = caiman.InventoryIndex(page_size=50)
+        with self.server.patch_caiman():
+            assert len(index.by_tag('soma-demo-web')) == 50
+            assert self.server.calls == 4
+            assert len(index.by_role('web')) == 100
+            assert len(index.by_role('role0', 'demo')) == 3
+            assert len(index.by_environment('production')) == 100
+            assert len(index.by_vpc('vpc-00000001')) == 200
+            assert len(index.by_zone('eu-west-1a')) == 67
+            assert index.by_tag('nothing') == []
+        assert self.server.calls == 4
+
+    def test_answers_running_instances(self):
+        index = caiman.InventoryIndex()
+        with self.server.patch_caiman():
+            running_instances = caiman.RunningInstances('test_inventory',
+                                                        inventory=index)
+            assert list(running_instances.addresses('role0')) == public_names(
+                1, 81, 161)
+            resolved = running_instances.resolve_many(['web', 'role1'])
+            assert [len(resolved[role]) for role in ['web', 'role1']] == [50, 3]
+            other_vpc = caiman.RunningInstances('test_inventory',
+                                                vpc_id='vpc-other',
+                                                inventory=index)
+            assert list(other_vpc.get_instances('web')) == []
+        assert self.server.calls == 1
+
+    def test_refreshes_on_schedule(self):
+        index = caiman.InventoryIndex(interval=0.05)
+        with self.server.patch_caiman():
+            index.start()
+            try:
+                assert wait_for(lambda: self.server.calls >= 2)
+                assert index.running
+            finally:
+                index.stop()
+        assert not index.running
+        assert index.updated is not None
+
+
+class TestParseName(object):
+
+    def test_inverts_get_name(self):
+        assert caiman.parse_name(caiman.get_name('database-replica', 'demo')) \
+            == ('database-replica', 'demo')
+
+    def test_other_tags(self):
+        assert caiman.parse_name('Name') is None
+        assert caiman.parse_name('soma-demo') is None
+
+
+class TestFilters(object):
+
+    def test_converts_to_ec2_filters(self):
+        filters = caiman.Filters(vpc_id='vpc-1', availability_zone='eu-west-1a',
+                                 instance_type=['m1.small', 'm1.large'],
+                                 subnet_id='subnet-1', tags={'team': 'search'})
+        assert filters.to_ec2() == {
+            'vpc-id': 'vpc-1',
+            'availability-zone': 'eu-west-1a',
+            'instance-type': ['m1.small', 'm1.large'],
+            'subnet-id': 'subnet-1',
+            'tag:team': 'search',
+        }
+        assert caiman.Filters.from_ec2(filters.to_ec2()).key() == filters.key()
+
+    def test_parses_specs(self):
+        filters = caiman.Filters.parse(['instance-type=m1.small,m1.large',
+                                        'tag:team=search'])
+        assert filters.instance_type == ['m1.small', 'm1.large']
+        assert filters.tags == {'team': 'search'}
+        assert not caiman.Filters.parse([])
+        for spec in ['colour=red', 'tag:team']:
+            with pytest.raises(ValueError):
+                caiman.Filters.parse([spec])
+
+    def test_matches_instances(self):
+        instance = fudge.Fake('instance').has_attr(
+            vpc_id='vpc-1', placement='eu-west-1a', instance_type='m1.small',
+            subnet_id='subnet-1', tags={'team': 'search'})
+        assert caiman.Filters(instance_type=['m1.small', 'm1.large'],
+                              tags={'team': 'search'}).matches(instance)
+        assert not caiman.Filters(availability_zone='eu-west-1b').matches(
+            instance)
+        assert not caiman.Filters(tags={'owner': 'ops'}).matches(instance)
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_running_instances_send_filters_to_ec2(self, get_running_instances):
+        (get_running_instances
+         .expects_call()
+         .with_args('some_name', filters={'availability-zone': 'eu-west-1a'})
+         .returns(iter([])))
+
+        running_instances = caiman.RunningInstances(
+            filters=caiman.Filters(availability_zone='eu-west-1a'))
+        assert list(running_instances.get_instances('some_name')) == []
+
+    def test_filters_are_applied_by_ec2(self):
+        os.environ['test_filters'] = u'demo'
+        filters = caiman.Filters(availability_zone='eu-west-1a',
+                                 instance_type='m1.small')
+        with FakeEc2Server(make_fleet(200)) as server:
+            with server.patch_caiman():
+                running_instances = caiman.RunningInstances(
+                    'test_filters', filters=filters)
+                web = list(running_instances.get_instances('web'))
+                resolved = running_instances.resolve_many(['web', 'role0'])
+                inventory = caiman.RunningInstances(
+                    'test_filters', filters=filters,
+                    inventory=caiman.InventoryIndex())
+                indexed = list(inventory.get_instances('web'))
+        assert len(web) == 17
+        assert all(instance.placement == 'eu-west-1a' and
+                   instance.instance_type == 'm1.small' for instance in web)
+        assert len(resolved['web']) == 17
+        assert [i.id for i in indexed] == [i.id for i in web]
+
+
+class TestMetrics(object):
+
+    def setup_method(self, method):
+        caiman.connection_pool.clear()
+        self.metrics = caiman.Metrics()
+        self.previous = caiman.set_instrumentation(self.metrics)
+
+    def teardown_method(self, method):
+        caiman.set_instrumentation(self.previous)
+
+    def test_counters_and_histograms(self):
+        self.metrics.increment('calls', region='eu-west-1')
+        self.metrics.increment('calls', 2, region='eu-west-1')
+        self.metrics.observe('seconds', 0.2)
+        self.metrics.observe('seconds', 0.004)
+        snapshot = self.metrics.snapshot()
+        assert snapshot['counters'] == {'calls{region=eu-west-1}': 3}
+        seconds = snapshot['histograms']['seconds']
+        assert seconds['count'] == 2
+        assert seconds['min'] == 0.004
+        assert seconds['max'] == 0.2
+        assert seconds['buckets']['0.005'] == 1
+        assert seconds['buckets']['0.25'] == 2
+        assert seconds['buckets']['inf'] == 2
+
+    def test_reset(self):
+        self.metrics.increment('calls')
+        self.metrics.reset()
+        assert self.metrics.snapshot() == {'counters': {}, 'histograms': {}}
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_records_api_calls_and_instances(self, connect_to_region):
+        reservations = [fudge.Fake('reservation').has_attr(instances=[1, 2])]
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances')
+                      .returns(reservations))
+        connect_to_region.expects_call().returns(connection)
+
+        assert list(caiman.get_running_instances('logger')) == [1, 2]
+        snapshot = self.metrics.snapshot()
+        assert snapshot['counters'] == {'ec2.requests{region=eu-west-1}': 1}
+        assert snapshot['histograms'][
+            'ec2.request_seconds{region=eu-west-1}']['count'] == 1
+        assert snapshot['histograms'][
+            'discovery.instances{tag=logger}']['sum'] == 2
+
+    @fudge.patch('caiman.connect_to_region')
+    def test_records_api_errors(self, connect_to_region):
+        def throttled(filters):
+            raise IOError('RequestLimitExceeded')
+        connection = (fudge.Fake('connection')
+                      .expects('get_all_instances').calls(throttled))
+        connect_to_region.expects_call().returns(connection)
+
+        with pytest.raises(IOError):
+            list(caiman.get_running_instances('logger'))
+        counters = self.metrics.snapshot()['counters']
+        assert counters['ec2.errors{region=eu-west-1}'] == 1
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_records_cache_and_wrapping(self, get_running_instances):
+        public = type('public', (object, ), {'publicIp': '44.55'})
+        get_running_instances.expects_call().returns(iter([public]))
+
+        running_instances = caiman.RunningInstances(
+            cache=caiman.DiscoveryCache())
+        running_instances.first_address('logger')
+        running_instances.first_address('logger')
+        snapshot = self.metrics.snapshot()
+        assert snapshot['counters'] == {'cache.misses': 1, 'cache.hits': 1}
+        assert snapshot['histograms']['discovery.wrap_seconds']['count'] == 1
+        assert snapshot['histograms'][
+            'discovery.address_seconds']['count'] == 1
+
+
+class TestImport(object):
+
+    def test_import_does_not_load_boto(self):
+        """importing caiman stays cheap by deferring boto until discovery"""
+        code = ('import sys, caiman; '
+                'print(",".join(m for m in sys.modules if m == "boto" '
+                'or m.startswith("boto.") or m.startswith("concurrent.")))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        assert output.strip() == b''
+
+    @fudge.patch('boto.ec2.connect_to_region')
+    def test_connect_to_region_delegates_to_boto(self, connect_to_region):
+        connection = fudge.Fake('connection')
+        (connect_to_region
+         .expects_call()
+         .with_args('eu-west-1')
+         .returns(connection))
+        assert caiman.connect_to_region('eu-west-1') is connection
+
+
 class TestAddRemoteLogger(object):
 
     def test_adds_graypy_handler_to_config(self):
@@ -184,6 +1743,235 @@ class TestAddRemoteLogger(object):
                                                   log_config)
         assert updated_config['handlers']['graypy']['host'] == remote_address
 
+    def test_buffered_handler_wraps_graypy_handler(self):
+        log_config = {'handlers': {}, 'loggers': {'app': {'handlers': []}}}
+        caiman.add_remote_logger('10.44.22.241', 'app', log_config,
+                                 buffered=True, capacity=10)
+        assert log_config['handlers']['graypy'] == {
+            'class': 'caiman.BufferedHandler',
+            'handler': 'graypy.GELFHandler',
+            'host': '10.44.22.241',
+            'port': 12201,
+            'capacity': 10,
+        }
+
+
+class CollectingHandler(logging.Handler):
+
+    def __init__(self, delay=None):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.delay = delay
+
+    def emit(self, record):
+        if self.delay is not None:
+            self.delay.wait(1)
+        self.records.append(record.getMessage())
+
+
+class TestBufferedHandler(object):
+
+    def make_logger(self, handler):
+        log = logging.getLogger('caiman_test.buffered.{}'.format(id(handler)))
+        log.propagate = False
+        log.addHandler(handler)
+        return log
+
+    def test_sends_records_from_background_thread(self):
+        target = CollectingHandler()
+        handler = caiman.BufferedHandler(target)
+        log = self.make_logger(handler)
+        log.error('hello %s', 'world')
+        handler.flush()
+        assert target.records == ['hello world']
+        handler.close()
+
+    def test_slow_handler_does_not_block_logging(self):
+        release = threading.Event()
+        target = CollectingHandler(delay=release)
+        handler = caiman.BufferedHandler(target, capacity=1)
+        log = self.make_logger(handler)
+        for number in range(3):
+            log.error('record %d', number)
+        assert handler.dropped >= 1
+        release.set()
+        handler.flush()
+        assert len(target.records) + handler.dropped == 3
+        handler.close()
+
+    def test_blocks_when_asked_to(self):
+        release = threading.Event()
+        target = CollectingHandler(delay=release)
+        handler = caiman.BufferedHandler(target, capacity=1, block=True,
+                                         timeout=0.05)
+        log = self.make_logger(handler)
+        for number in range(3):
+            log.error('record %d', number)
+        release.set()
+        handler.flush()
+        assert len(target.records) + handler.dropped == 3
+        assert len(target.records) >= 2
+
+    def test_close_sends_queued_records(self):
+        target = CollectingHandler()
+        handler = caiman.BufferedHandler(target, batch_size=2)
+        log = self.make_logger(handler)
+        for number in range(5):
+            log.error('record %d', number)
+        handler.close()
+        assert target.records == ['record {}'.format(n) for n in range(5)]
+
+    def test_role_is_resolved_by_remote_logger_handler(self):
+        log_config = {'handlers': {}, 'loggers': {'app': {'handlers': []}}}
+        caiman.add_remote_logger(None, 'app', log_config, role='logger',
+                                 environment_variable='SOMA_ENVIRONMENT')
+        assert log_config['handlers']['graypy'] == {
+            'class': 'caiman.RemoteLoggerHandler',
+            'role': 'logger',
+            'port': 12201,
+            'environment_variable': 'SOMA_ENVIRONMENT',
+        }
+        assert log_config['loggers']['app']['handlers'] == ['graypy']
+
+    def test_wrapped_handler_can_be_named(self):
+        handler = caiman.BufferedHandler('logging.StreamHandler',
+                                         stream=sys.stderr)
+        assert isinstance(handler.target, logging.StreamHandler)
+        assert handler.target.stream is sys.stderr
+
+
+class HostHandler(CollectingHandler):
+    """Handler sending to a host, failing for hosts in `down`"""
+
+    down = set()
+    sent = []
+
+    def __init__(self, host, port):
+        CollectingHandler.__init__(self)
+        self.host = host
+
+    def emit(self, record):
+        if self.host in self.down:
+            self.handleError(record)
+        else:
+            self.sent.append((self.host, record.getMessage()))
+
+
+class TestRemoteLoggerHandler(object):
+
+    def setup_method(self, method):
+        HostHandler.down = set()
+        HostHandler.sent = []
+
+    def make_handler(self, running_instances):
+        handler = caiman.RemoteLoggerHandler(
+            'logger', handler=HostHandler, running_instances=running_instances,
+            shutdown_timeout=1)
+        log = logging.getLogger('caiman_test.remote.{}'.format(id(handler)))
+        log.propagate = False
+        log.addHandler(handler)
+        return handler, log
+
+    def test_buffers_until_logger_is_found(self):
+        running_instances = WatchedInstances([Host('i-a', 'a')])
+        handler, log = self.make_handler(running_instances)
+        log.error('before')
+        assert handler.host is None
+        running_instances.watcher.refresh()
+        log.error('after')
+        handler.flush()
+        assert HostHandler.sent == [('a', 'before'), ('a', 'after')]
+        handler.close()
+
+    def test_follows_membership_changes(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a')], [Host('i-b', 'b')])
+        handler, log = self.make_handler(running_instances)
+        running_instances.watcher.refresh()
+        assert handler.host == 'a'
+        running_instances.watcher.refresh()
+        assert handler.host == 'b'
+        handler.close()
+
+    def test_switches_host_when_sending_fails(self):
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a'), Host('i-b', 'b')])
+        handler, log = self.make_handler(running_instances)
+        running_instances.watcher.refresh()
+        first = handler.host
+        HostHandler.down.add(first)
+        log.error('lost')
+        handler.flush()
+        assert wait_for(lambda: handler.host not in (None, first))
+        log.error('delivered')
+        handler.flush()
+        assert HostHandler.sent == [(handler.host, 'delivered')]
+        handler.close()
+
+    def test_membership_change_during_slow_send(self):
+        started, release = threading.Event(), threading.Event()
+        closed = []
+
+        class SlowHostHandler(HostHandler):
+
+            def emit(self, record):
+                started.set()
+                release.wait(1)
+                HostHandler.emit(self, record)
+
+            def close(self):
+                closed.append((self.host, list(HostHandler.sent)))
+                HostHandler.close(self)
+
+        running_instances = WatchedInstances(
+            [Host('i-a', 'a')], [Host('i-b', 'b')])
+        handler = caiman.RemoteLoggerHandler(
+            'logger', handler=SlowHostHandler,
+            running_instances=running_instances, shutdown_timeout=1)
+        log = logging.getLogger('caiman_test.remote.{}'.format(id(handler)))
+        log.propagate = False
+        log.addHandler(handler)
+        running_instances.watcher.refresh()
+        log.error('slow')
+        assert started.wait(1)
+        switch = threading.Thread(target=running_instances.watcher.refresh)
+        switch.start()
+        release.set()
+        switch.join(1)
+        assert handler.host == 'b'
+        # the previous handler is closed once its batch has been sent
+        assert closed == [('a', [('a', 'slow')])]
+        log.error('after')
+        handler.flush()
+        assert HostHandler.sent == [('a', 'slow'), ('b', 'after')]
+        handler.close()
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_close_stops_watching(self, get_running_instances):
+        calls = []
+
+        def discover(name):
+            calls.append(name)
+            return iter([Host('i-a', 'a')])
+        get_running_instances.expects_call().calls(discover)
+
+        handler = caiman.RemoteLoggerHandler(
+            'logger', handler=HostHandler, interval=0.01, shutdown_timeout=1)
+        assert wait_for(lambda: len(calls) > 1)
+        handler.close()
+        assert not handler.watcher.running
+        handler.watcher._thread.join(1)
+        made = len(calls)
+        threading.Event().wait(0.05)
+        assert len(calls) == made
+
+    def test_close_does_not_wait_for_unresolved_logger(self):
+        handler, log = self.make_handler(WatchedInstances())
+        log.error('never sent')
+        handler.flush()
+        handler.close()
+        assert HostHandler.sent == []
+
 
 class TestAddressLookupOrder(object):
 
@@ -222,3 +2010,233 @@ class TestAddressLookupOrder(object):
         with ri.address_lookup_order('localhost'):
             pass
         assert ri.address_attributes == []
+
+    def test_context_managers_nest(self):
+        ri = caiman.RunningInstances()
+        with ri.address_lookup_order('outer'):
+            with ri.address_lookup_order('inner'):
+                assert ri.address_attributes == ['inner']
+            assert ri.address_attributes == ['outer']
+
+    def test_reset_returns_to_shared_order(self):
+        ri = caiman.RunningInstances.address_order(address_attributes=['shared'])
+        ri.set_address_lookup_order('mine')
+        ri.reset_address_lookup_order()
+        assert ri.address_attributes == ['shared']
+
+    def test_order_is_local_to_thread(self):
+        ri = caiman.RunningInstances()
+        other = caiman.RunningInstances()
+        ri.set_address_lookup_order('main')
+        seen = []
+
+        def worker():
+            seen.append(ri.address_attributes)
+            with ri.address_lookup_order('worker'):
+                seen.append(ri.address_attributes)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert seen == [[], ['worker']]
+        assert ri.address_attributes == ['main']
+        assert other.address_attributes == []
+        ri.reset_address_lookup_order()
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_shared_cache_serves_each_order(self, get_running_instances):
+        host = type('host', (object, ), {'publicIp': 'public',
+                                         'private_ip_address': 'private'})
+        get_running_instances.expects_call().calls(lambda name: iter([host]))
+
+        ri = caiman.RunningInstances(cache=caiman.DiscoveryCache())
+        results = {}
+
+        def worker(order):
+            with ri.address_lookup_order(order):
+                results[order] = ri.first_address('some_name')
+
+        threads = [threading.Thread(target=worker, args=(order, ))
+                   for order in ('publicIp', 'private_ip_address')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {'publicIp': 'public',
+                           'private_ip_address': 'private'}
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_order_is_local_to_asyncio_task(self, get_running_instances):
+        host = type('host', (object, ), {'publicIp': 'public',
+                                         'private_ip_address': 'private'})
+        get_running_instances.expects_call().calls(lambda name: iter([host]))
+        ri = caiman.aio.AsyncRunningInstances()
+
+        async def lookup(order):
+            ri.set_address_lookup_order(order)
+            await asyncio.sleep(0)
+            return await ri.first_address('some_name')
+
+        async def lookups():
+            return await asyncio.gather(lookup('publicIp'),
+                                        lookup('private_ip_address'))
+
+        assert asyncio.run(lookups()) == ['public', 'private']
+
+
+class TestCircuitBreaker(object):
+
+    def setup_method(self, method):
+        self.clock = FakeClock()
+        self.breaker = caiman.CircuitBreaker(failure_threshold=2,
+                                             latency_threshold=1,
+                                             reset_timeout=30,
+                                             clock=self.clock)
+
+    def fail(self):
+        raise RuntimeError('boom')
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                self.breaker.call(self.fail)
+        assert self.breaker.state == caiman.CircuitBreaker.OPEN
+        with pytest.raises(caiman.CircuitOpenError):
+            self.breaker.call(lambda: 'not called')
+
+    def test_success_resets_failures(self):
+        with pytest.raises(RuntimeError):
+            self.breaker.call(self.fail)
+        assert self.breaker.call(lambda: 'ok') == 'ok'
+        with pytest.raises(RuntimeError):
+            self.breaker.call(self.fail)
+        assert self.breaker.state == caiman.CircuitBreaker.CLOSED
+
+    def test_slow_calls_count_as_failures(self):
+        def slow():
+            self.clock.now += 2
+            return 'late'
+
+        assert self.breaker.call(slow) == 'late'
+        assert self.breaker.call(slow) == 'late'
+        assert self.breaker.state == caiman.CircuitBreaker.OPEN
+
+    def test_half_open_lets_one_trial_through(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.clock.now += 30
+        assert self.breaker.state == caiman.CircuitBreaker.HALF_OPEN
+        assert self.breaker.allow()
+        assert not self.breaker.allow()
+        self.breaker.record_failure()
+        assert self.breaker.state == caiman.CircuitBreaker.OPEN
+
+        self.clock.now += 30
+        assert self.breaker.call(lambda: 'ok') == 'ok'
+        assert self.breaker.state == caiman.CircuitBreaker.CLOSED
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_last_known_good_instances_while_ec2_fails(self,
+                                                       get_running_instances):
+        calls = []
+
+        def discover(name):
+            calls.append(name)
+            if len(calls) > 1:
+                raise RuntimeError('ec2 is down')
+            return iter([Host('a', 'public-a')])
+        get_running_instances.expects_call().calls(discover)
+
+        running_instances = caiman.RunningInstances(breaker=self.breaker)
+        instance, = running_instances.get_instances('db')
+        assert not instance.stale
+
+        for _ in range(3):
+            instance, = running_instances.get_instances('db')
+            assert instance.stale
+            assert instance.address == 'public-a'
+        assert running_instances.first_address('db') == 'public-a'
+        # the circuit opened after two failures, so ec2 was left alone
+        assert len(calls) == 3
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_live_path_returns_once_ec2_recovers(self, get_running_instances):
+        hosts = {'db': [Host('a', 'public-a')]}
+
+        def discover(name):
+            if hosts['db'] is None:
+                raise RuntimeError('ec2 is down')
+            return iter(hosts['db'])
+        get_running_instances.expects_call().calls(discover)
+
+        running_instances = caiman.RunningInstances(breaker=self.breaker)
+        assert running_instances.first_address('db') == 'public-a'
+        hosts['db'] = None
+        for _ in range(2):
+            assert running_instances.first_address('db') == 'public-a'
+        assert self.breaker.state == caiman.CircuitBreaker.OPEN
+
+        hosts['db'] = [Host('b', 'public-b')]
+        assert running_instances.first_address('db') == 'public-a'
+        self.clock.now += 30
+        instance, = running_instances.get_instances('db')
+        assert instance.address == 'public-b'
+        assert not instance.stale
+
+    @fudge.patch('caiman.get_running_instances')
+    def test_cached_stale_instances_are_refreshed(self,
+                                                  get_running_instances):
+        hosts = {'db': [Host('a', 'public-a')]}
+        calls = []
+
+        def discover(name):
+            calls.append(name)
+            if hosts['db'] is None:
+                raise RuntimeError('ec2 is down')
+            return iter(hosts['db'])
+        get_running_instances.expects_call().calls(discover)
+
+        cache = caiman.DiscoveryCache(ttl=60, clock=self.clock)
+        running_instances = caiman.RunningInstances(
+            cache=cache, breaker=caiman.CircuitBreaker(
+                failure_threshold=1, reset_timeout=30, clock=self.clock))
+
+        def lookup():
+            instance, = running_instances.get_instances('db')
+            assert wait_for(lambda: not cache._refreshing)
+            return instance
+
+        assert not lookup().stale
+        hosts['db'] = None
+        self.clock.now += 60
+        lookup()  # refreshes in the background, opening the circuit
+        assert lookup().stale
+        assert len(calls) == 2
+
+        hosts['db'] = [Host('b', 'public-b')]
+        self.clock.now += 30
+        assert lookup().stale
+        # the stale entry was expired, so this lookup reached ec2
+        assert len(calls) == 3
+        instance = lookup()
+        assert instance.address == 'public-b'
+        assert not instance.stale
+
+    @fudge.patch('caiman.get_running_instances_by_tag')
+    def test_resolve_many_without_last_known_good_raises(
+            self, get_running_instances_by_tag):
+        (get_running_instances_by_tag
+         .expects_call()
+         .returns({'db': [Host('a', 'public-a')]})
+         .next_call()
+         .raises(RuntimeError('ec2 is down'))
+         .next_call()
+         .raises(RuntimeError('ec2 is down')))
+
+        running_instances = caiman.RunningInstances(records=True,
+                                                    breaker=self.breaker)
+        running_instances.resolve_many(['db'])
+        resolved = running_instances.resolve_many(['db'])
+        assert [i.stale for i in resolved['db']] == [True]
+        with pytest.raises(RuntimeError):
+            running_instances.resolve_many(['db', 'web'])
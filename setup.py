@@ -24,7 +24,11 @@ setup(
     zip_safe=False,
     install_requires=[
         'boto==2.8.0',
+        'futures; python_version < "3"',
     ],
+    entry_points={
+        'console_scripts': ['caiman = caiman.cli:main'],
+    },
     tests_require=['fudge==1.0.3', 'pytest==2.3.4'],
     cmdclass={'test': PyTest},
 )